@@ -5,10 +5,12 @@ from datetime import datetime
 import hashlib
 
 from appdirs import user_data_dir
-from pyrogram import Client, filters
+import pyrogram
+from pyrogram import filters
 from pyrogram.filters import Filter
 from pyrogram.types import InputMedia, Message as TM, CallbackQuery as TC
 from pyrogram.enums import ParseMode
+from pyrogram.raw import functions
 from pyrubrum import (
     ParameterizedHandler,
     DictDatabase,
@@ -27,6 +29,43 @@ from .. import __product__
 from ..utils import to_iterable
 from ..config import config
 from ..cache import Cache
+from .ratelimit import RateLimiter, limited
+
+# Requests which send or change messages, and count against the flood limits of the bot.
+OUTGOING = (
+    functions.messages.SendMessage,
+    functions.messages.SendMedia,
+    functions.messages.SendMultiMedia,
+    functions.messages.ForwardMessages,
+    functions.messages.EditMessage,
+    functions.messages.DeleteMessages,
+    functions.messages.UpdatePinnedMessage,
+    functions.messages.UnpinAllMessages,
+    functions.messages.SetBotCallbackAnswer,
+)
+
+
+def target_chat(query):
+    peer = getattr(query, "peer", None) or getattr(query, "to_peer", None)
+    for attr in ("user_id", "chat_id", "channel_id"):
+        chat_id = getattr(peer, attr, None)
+        if chat_id:
+            return chat_id
+    return None
+
+
+class Client(pyrogram.Client):
+    limiter: RateLimiter = None
+
+    async def invoke(self, query, *args, sleep_threshold: float = None, **kw):
+        if limited.get():
+            # Flood waits inside rate limited calls are handed to the limiter instead of sleeping here.
+            if sleep_threshold is None:
+                sleep_threshold = 0
+        elif self.limiter and isinstance(query, OUTGOING):
+            # Replies and menus of handlers take tokens from the same buckets as fan-outs.
+            await self.limiter.acquire(target_chat(query))
+        return await super().invoke(query, *args, sleep_threshold=sleep_threshold, **kw)
 
 
 @dataclass
@@ -7,9 +7,11 @@ from peewee import fn
 
 import anonyabbot
 
+from ... import dbio
 from ...utils import to_iterable, truncate_str
-from ...model import User, UserRole, Group, Member, Message
+from ...model import User, UserRole, Group, shards
 from ..pool import start_time, worker_status, stop_group_bot
+from ..group.voice import service as voice_service
 from .common import operation
 
 
@@ -28,6 +30,14 @@ class Admin:
         latest_user: User = User.select().order_by(User.created.desc()).get()
         running_time = ":".join(str(datetime.now() - start_time).split(":")[:3]).split('.')[0]
         waiting_delay = f"{worker_status['time'] / worker_status['requests']:.1f} 秒" if worker_status['requests'] else "无数据"
+        voice_status = voice_service.status
+        voice_cpu_time = f"{voice_status['cpu_time'] / voice_status['jobs']:.1f} 秒" if voice_status['jobs'] else "无数据"
+        cp_status = dbio.checkpointer.status
+        cp_time = (
+            f"{cp_status['time'] / cp_status['checkpoints'] * 1000:.0f} / {cp_status['max_time'] * 1000:.0f} 毫秒"
+            if cp_status['checkpoints']
+            else "无数据"
+        )
         msg = f"ℹ️ 系统信息:\n\n"
         fields = [
             f"用户数: {User.select().count()}",
@@ -40,7 +50,11 @@ class Admin:
             f"活跃群组数: {n_active_groups}",
             f"运行时间: {running_time}",
             f"平均传播延迟: {waiting_delay}",
-            f"消息数: {Message.select().count()}",
+            f"语音处理队列: {voice_status['pending']}",
+            f"语音平均处理时间: {voice_cpu_time}",
+            f"消息数: {Group.select(fn.SUM(Group.message_count)).scalar() or 0}",
+            f"WAL 大小: {cp_status['wal_size'] / 1024 / 1024:.1f} MB",
+            f"检查点耗时 (平均 / 最长): {cp_time}",
         ]
         msg += indent("\n".join(fields), "  ")
         return msg
@@ -92,7 +106,7 @@ class Admin:
         roles = [UserRole(int(i)) for i in parameters["gcsr_current"]]
         days = int(parameters["generate_codes_select_num_id"])
         num = int(parameters["generate_codes_id"])
-        user: User = context.from_user.get_record()
+        user: User = await dbio.get_record(context.from_user)
         msg = "⭐ 生成的身份码:\n\n"
         for c in to_iterable(user.create_code(roles, days=days, num=num)):
             msg += f"`{c}`\n"
@@ -114,11 +128,11 @@ class Admin:
             else:
                 groups = groups.order_by(Group.last_activity)
         else:
-            groups = Group.select(Group, fn.COUNT(Member.id).alias("num_members")).join(Member).group_by(Group.id)
+            groups = Group.select()
             if desc:
-                groups = groups.order_by(fn.Count(Member.id).desc())
+                groups = groups.order_by(Group.member_count.desc())
             else:
-                groups = groups.order_by(fn.Count(Member.id))
+                groups = groups.order_by(Group.member_count)
         items = []
         g: Group
         for i, g in enumerate(groups.iterator()):
@@ -222,7 +236,7 @@ class Admin:
             f"消息数: {group.n_messages}",
             f"禁用: {'**是**' if group.disabled else '否'}",
             f"创建时间: {group.created.strftime('%Y-%m-%d')}",
-            f"最近活动时间: {group.last_activity.strftime('%Y-%m-%d')}",
+            f"最近活动时间: {group.last_active.strftime('%Y-%m-%d')}",
         ]
         msg += indent("\n".join(fields), "  ")
         return msg
@@ -252,7 +266,9 @@ class Admin:
     ):
         group: Group = Group.get_by_id(parameters["group_id"])
         group.disabled = True
-        group.save()
+        await dbio.save(group)
         await stop_group_bot(group.token)
+        if shards.enabled:
+            await dbio.io.write(shards.drop, group.id)
         await context.answer("✅ 成功")
         await self.to_menu("_group_detail_admin", context)
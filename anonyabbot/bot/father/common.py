@@ -6,6 +6,7 @@ from pyrogram.types import Message as TM, CallbackQuery as TC
 
 import anonyabbot
 
+from ... import dbio
 from ...model import OperationError, UserRole, User
 
 
@@ -23,11 +24,11 @@ def operation(req: UserRole = None, prohibited: UserRole = UserRole.BANNED, conv
             try:
                 if not conversation:
                     self.set_conversation(context, status=None)
-                user: User = context.from_user.get_record()
+                user: User = await dbio.get_record(context.from_user)
                 if req:
-                    user.validate(req, fail=True)
+                    await dbio.validate(user, req, fail=True)
                 if prohibited:
-                    user.validate(prohibited, fail=True, reversed=True)
+                    await dbio.validate(user, prohibited, fail=True, reversed=True)
                 return await func(*args, **kw)
             except ContinuePropagation:
                 raise
@@ -6,6 +6,7 @@ from pyrogram.errors import RPCError
 
 import anonyabbot
 
+from ... import dbio
 from ...utils import async_partial
 from ...model import User, Group
 from ..pool import start_group_bot
@@ -21,7 +22,7 @@ class OnMessage:
     ):
         info = async_partial(self.info, context=message, time=None)
         conv = self.conversation.get((message.chat.id, message.from_user.id), None)
-        user: User = message.from_user.get_record()
+        user: User = await dbio.get_record(message.from_user)
         if not conv:
             message.continue_propagation()
         try:
@@ -29,7 +30,7 @@ class OnMessage:
                 if message.text.startswith("/"):
                     message.continue_propagation()
                 if conv.status == "use_code":
-                    used = user.use_code(message.text)
+                    used = await dbio.io.write(user.use_code, message.text)
                     if used:
                         msg = "ℹ️ 你已成为以下角色:\n"
                         for u in used:
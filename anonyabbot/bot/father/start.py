@@ -4,7 +4,8 @@ from pyrogram.types import Message as TM, CallbackQuery as TC
 
 import anonyabbot
 
-from ...model import User, Group, UserRole
+from ... import dbio
+from ...model import User, Group, UserRole, shards
 from ...config import config
 from ...utils import remove_prefix, truncate_str
 from ..pool import stop_group_bot
@@ -45,7 +46,7 @@ class Start:
         context: TC,
         parameters: dict,
     ):
-        user: User = context.from_user.get_record()
+        user: User = await dbio.get_record(context.from_user)
         msg = (
             f"ℹ️ {user.name} 的个人信息:\n\n"
             f" ID: {user.uid}\n"
@@ -67,7 +68,7 @@ class Start:
         context: TC,
         parameters: dict,
     ):
-        user: User = context.from_user.get_record()
+        user: User = await dbio.get_record(context.from_user)
         code = user.create_code(UserRole.INVITED, length = 8)
         days = config.get('father.invite_award_days', 180)
         return (
@@ -85,8 +86,8 @@ class Start:
         parameters: dict,
     ):
         if 'code' in parameters:
-            user: User = context.from_user.get_record()
-            used = user.use_code(parameters['code'])
+            user: User = await dbio.get_record(context.from_user)
+            used = await dbio.io.write(user.use_code, parameters['code'])
             if len(used) == 1 and used[0].role == UserRole.INVITED:
                 days = config.get('father.invite_award_days', 180)
                 msg = (
@@ -133,7 +134,7 @@ class Start:
         context: TC,
         parameters: dict,
     ):
-        user: User = context.from_user.get_record()
+        user: User = await dbio.get_record(context.from_user)
         items = []
         g: Group
         for i, g in enumerate(user.groups(created=True)):
@@ -173,7 +174,7 @@ class Start:
             f"消息数: {group.n_messages}",
             f"已禁用: {'**是**' if group.disabled else '否'}",
             f"创建时间: {group.created.strftime('%Y-%m-%d')}",
-            f"最后活动时间: {group.last_activity.strftime('%Y-%m-%d')}",
+            f"最后活动时间: {group.last_active.strftime('%Y-%m-%d')}",
         ]
         msg += indent("\n".join(fields), "  ")
         msg += "\n\n⬇️ 请点击下面的按钮来配置群组: "
@@ -205,6 +206,8 @@ class Start:
         group: Group = Group.get_by_id(parameters["group_id"])
         await stop_group_bot(group.token)
         group.disabled = True
-        group.save()
+        await dbio.save(group)
+        if shards.enabled:
+            await dbio.io.write(shards.drop, group.id)
         await context.answer("✅ 群组已删除")
         await self.to_menu("list_group", context)
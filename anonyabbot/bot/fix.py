@@ -1,9 +1,57 @@
+from typing import Dict
+
 from loguru import logger
 from pyrogram.types import User as TU
 
 from ..model import db, User, Group, UserRole
 
 
+class UserRecords:
+    """Identity cache of user records by telegram id, profile changes are only written on flush."""
+
+    def __init__(self, size: int = 100000):
+        self.size = size
+        self.users: Dict[int, User] = {}
+        self.dirty: Dict[int, User] = {}
+
+    def get(self, uid: int):
+        ur = self.users.get(uid, None)
+        if not ur:
+            ur = User.get_or_none(uid=uid)
+            if ur:
+                self.add(ur)
+        return ur
+
+    def add(self, ur: User):
+        if len(self.users) >= self.size:
+            self.users.pop(next(iter(self.users)), None)
+        self.users[ur.uid] = ur
+
+    def sync(self, ur: User, username: str, firstname: str, lastname: str):
+        if (ur.username, ur.firstname, ur.lastname) != (username, firstname, lastname):
+            ur.username = username
+            ur.firstname = firstname
+            ur.lastname = lastname
+            self.dirty[ur.uid] = ur
+
+    def take(self) -> Dict[int, User]:
+        """Swap out changed records on the event loop, where they are changed, to be written by flush()."""
+        dirty, self.dirty = self.dirty, {}
+        return dirty
+
+    def flush(self, dirty: Dict[int, User] = None):
+        if dirty is None:
+            dirty = self.take()
+        if dirty:
+            with db.atomic():
+                for ur in dirty.values():
+                    ur.save(only=[User.username, User.firstname, User.lastname])
+        return len(dirty)
+
+
+user_records = UserRecords()
+
+
 def patch_pyrogram():
     def name(self: TU):
         naming = (self.first_name, self.last_name)
@@ -13,24 +61,23 @@ def patch_pyrogram():
             return " ".join([n for n in naming if n])
 
     def get_record(self: TU, create=True):
-        ur: User = User.get_or_none(uid=self.id)
+        ur: User = user_records.get(self.id)
         if not ur:
             if create:
                 with db.atomic():
-                    ur = User.create(uid=self.id)
+                    first = not User.select().exists()
+                    ur = User.create(uid=self.id, username=self.username, firstname=self.first_name, lastname=self.last_name)
                     logger.trace(f"New user: {self.name}.")
-                    if User.select().count() == 1:
+                    if first:
                         ur.add_role([UserRole.CREATOR, UserRole.ADMIN])
-                        ur.save()
                         logger.warning(f"First user is set as super admin: {self.name}.")
+                user_records.add(ur)
             else:
                 return None
-        if ur:
-            ur.username = self.username
-            ur.firstname = self.first_name
-            ur.lastname = self.last_name
-            ur.save()
-            return ur
+        return ur
+
+    def sync_record(self: TU, ur: User):
+        user_records.sync(ur, self.username, self.first_name, self.last_name)
 
     def get_member(self: TU, group: Group):
         user: User = self.get_record()
@@ -38,4 +85,5 @@ def patch_pyrogram():
 
     setattr(TU, "name", property(name))
     setattr(TU, "get_record", get_record)
+    setattr(TU, "sync_record", sync_record)
     setattr(TU, "get_member", get_member)
@@ -1,6 +1,6 @@
 import asyncio
 import hashlib
-from typing import Dict
+from typing import Dict, List, Tuple
 
 from loguru import logger
 from pyrogram import filters
@@ -8,13 +8,16 @@ from pyrogram.handlers import MessageHandler, EditedMessageHandler
 from pyrogram.errors import UserDeactivated, RPCError
 from pyrogram.types import BotCommand
 
+from ... import dbio
 from ...utils import truncate_str
-from ...cache import Cache, CacheDict
+from ...cache import BoundedCache, Cache, CacheDict
 from ...config import config
-from ...model import UserRole, db, BanGroup, Group, User, Member, MemberRole
+from ...model import UserRole, db, BanGroup, Group, User, Member, MemberRole, RedirectBuffer, ShardScope, current_shard
 from ..base import MenuBot
+from ..ratelimit import RateLimiter
 from .mask import UniqueMask
-from .worker import Worker, WorkerQueue
+from .recipients import RecipientSet
+from .worker import Operation, Worker, WorkerQueue
 from .on_message import OnMessage
 from .command import OnCommand
 from .tree import Tree
@@ -37,6 +40,12 @@ class GroupBot(MenuBot, _Methods):
         self.lock = asyncio.Lock()
         self.user_locks: Dict[Member, asyncio.Lock] = {}
         self.queue = WorkerQueue(f'group.{self.token}.worker.queue', self.bot)
+        self.fanout_limit = asyncio.Semaphore(config.get('worker.concurrency', 10))
+        self.limiter = RateLimiter(
+            rate=config.get('worker.rate', 25),
+            chat_rate=config.get('worker.chat_rate', 1),
+        )
+        self.bot.limiter = self.limiter
         self.worker_status = CacheDict(
             f'group.{self.token}.worker.status',
             default={
@@ -46,14 +55,25 @@ class GroupBot(MenuBot, _Methods):
             }
         )
         self.invite_codes = Cache(base=f'group.{self.token}.invite.code')
+        self.voice_cache = BoundedCache(
+            base=f'group.{self.token}.voice',
+            size=config.get('voice.cache_size', 10000),
+            ttl=config.get('voice.cache_ttl', 30 * 86400),
+        )
+        self.redirects = RedirectBuffer()
+        self.delivered: List[Tuple[Operation, int]] = []
+        self.recipient_set = RecipientSet(ttl=config.get('worker.recipients_ttl', 600))
         self.jobs.append(self.worker())
+        self.jobs.append(self.redirect_flusher())
         self.group: Group = Group.get_or_none(token=self.token)
         if self.group:
             self.creator = self.group.creator
         else:
             self.creator = creator
+        self.shard = ShardScope(self.group.id if self.group else None)
 
     async def start(self):
+        current_shard.set(self.shard)
         try:
             try:
                 await self.bot.start()
@@ -62,7 +82,7 @@ class GroupBot(MenuBot, _Methods):
                 if isinstance(e, UserDeactivated):
                     if self.group:
                         self.group.disabled = True
-                        self.group.save()
+                        await dbio.save(self.group)
                         logger.info(f"Group @{self.group.username} disabled because token deactivated.")
                 self.boot_exception = e
                 return
@@ -114,23 +134,29 @@ class GroupBot(MenuBot, _Methods):
         if not self.group:
             if not self.creator:
                 raise ValueError("must specify creator for group creation")
-            with db.atomic():
-                self.group = Group.create(
-                    uid=self.bot.me.id,
-                    token=self.bot.bot_token,
-                    username=self.bot.me.username,
-                    title=self.bot.me.name,
-                    creator=self.creator,
-                    default_ban_group=BanGroup.generate(),
-                )
-                Member.create(group=self.group, user=self.creator, role=MemberRole.CREATOR)
-                if not self.creator.validate(UserRole.GROUPER):
-                    self.creator.add_role(UserRole.GROUPER)
-                if self.creator.validate(UserRole.INVITED):
-                    days = config.get('father.invite_award_days', 180)
-                    self.creator.add_role(UserRole.AWARDED, days=days)
-                    if self.creator.invited_by:
-                        self.creator.invited_by.add_role(UserRole.AWARDED, days=days)
+
+            def create():
+                with db.atomic():
+                    group = Group.create(
+                        uid=self.bot.me.id,
+                        token=self.bot.bot_token,
+                        username=self.bot.me.username,
+                        title=self.bot.me.name,
+                        creator=self.creator,
+                        default_ban_group=BanGroup.generate(),
+                    )
+                    Member.create(group=group, user=self.creator, role=MemberRole.CREATOR)
+                    if not self.creator.validate(UserRole.GROUPER):
+                        self.creator.add_role(UserRole.GROUPER)
+                    if self.creator.validate(UserRole.INVITED):
+                        days = config.get('father.invite_award_days', 180)
+                        self.creator.add_role(UserRole.AWARDED, days=days)
+                        if self.creator.invited_by:
+                            self.creator.invited_by.add_role(UserRole.AWARDED, days=days)
+                return group
+
+            self.group = await dbio.io.write(create)
+            self.shard.group_id = self.group.id
         logger.info(f"Now listening updates in group: @{self.bot.me.username}.")
 
         await self.bot.set_bot_commands(
@@ -152,7 +178,8 @@ class GroupBot(MenuBot, _Methods):
 
     async def touch(self):
         if self.group:
-            self.group.username = self.bot.me.username
-            self.group.title = self.bot.me.name
-            self.group.save()
+            if (self.group.username, self.group.title) != (self.bot.me.username, self.bot.me.name):
+                self.group.username = self.bot.me.username
+                self.group.title = self.bot.me.name
+                await dbio.io.write(self.group.save, only=[Group.username, Group.title])
             self.group.touch()
\ No newline at end of file
@@ -0,0 +1,73 @@
+from io import BytesIO
+from typing import Iterator, Tuple
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+
+
+def info(data: bytes):
+    return sf.info(BytesIO(data))
+
+
+def decode(data: bytes, sr: int = None) -> Tuple[np.ndarray, int]:
+    """Decode an ogg voice to a mono float32 buffer, optionally resampled to sr."""
+    wav, orig_sr = sf.read(BytesIO(data), dtype="float32")
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1, dtype=np.float32)
+    if sr and sr != orig_sr:
+        return resample(wav, orig_sr, sr), sr
+    return wav, orig_sr
+
+
+def blocks(data: bytes, seconds: float, overlap: float, sr: int = None) -> Iterator[np.ndarray]:
+    """Decode an ogg voice block by block, each block starts overlap seconds before the previous one ends."""
+    with sf.SoundFile(BytesIO(data)) as f:
+        orig_sr = f.samplerate
+        size = int((seconds + overlap) * orig_sr)
+        for b in f.blocks(blocksize=size, overlap=int(overlap * orig_sr), dtype="float32"):
+            if b.ndim > 1:
+                b = b.mean(axis=1, dtype=np.float32)
+            if sr and sr != orig_sr:
+                b = resample(b, orig_sr, sr)
+            yield b
+
+
+def encode(wav: np.ndarray, sr: int) -> bytes:
+    """Encode a float buffer to an ogg/opus voice."""
+    encoder = Encoder(sr)
+    encoder.write(wav)
+    return encoder.close()
+
+
+class Encoder:
+    """Encode float buffers to an ogg/opus voice incrementally."""
+
+    def __init__(self, sr: int):
+        self.sr = sr
+        self.target = opus_rate(sr)
+        self.buffer = BytesIO()
+        self.file = sf.SoundFile(self.buffer, "w", samplerate=self.target, channels=1, format="OGG", subtype="OPUS")
+
+    def write(self, wav: np.ndarray):
+        if self.sr != self.target:
+            wav = resample(wav, self.sr, self.target)
+        wav = np.clip(wav, -1, 1, out=wav if wav.flags.writeable else None)
+        self.file.write(wav)
+
+    def close(self) -> bytes:
+        self.file.close()
+        return self.buffer.getvalue()
+
+
+def opus_rate(sr: int):
+    """Get the nearest sample rate supported by opus, which is not lower than sr."""
+    if sr in OPUS_RATES:
+        return sr
+    return min((r for r in OPUS_RATES if r >= sr), default=OPUS_RATES[-1])
+
+
+def resample(wav: np.ndarray, orig_sr: int, sr: int):
+    return librosa.resample(wav, orig_sr=orig_sr, target_sr=sr).astype(np.float32, copy=False)
@@ -1,6 +1,7 @@
 import asyncio
 import random
 import string
+from typing import Union
 from pyrogram import Client
 from pyrogram.types import Message as TM, CallbackQuery as TC
 from pyrogram.errors import RPCError
@@ -8,7 +9,8 @@ from pyrubrum import Element
 
 import anonyabbot
 
-from ...model import MemberRole, Member, OperationError, BanType, Message, PMBan, PMMessage, RedirectedMessage, User
+from ... import dbio
+from ...model import MemberRole, Member, OperationError, BanType, Message, PMBan, PMMessage, User
 from ...utils import async_partial, parse_timedelta
 from .common import operation
 from .worker import DeleteOperation, PinOperation, UnpinOperation
@@ -16,32 +18,21 @@ from .mask import MaskNotAvailable
 
 
 class OnCommand:
-    def get_member_reply_message(self: "anonyabbot.GroupBot", message: TM, allow_pm=False):
-        member: Member = message.from_user.get_member(self.group)
+    async def get_member_reply_message(self: "anonyabbot.GroupBot", message: TM, allow_pm=False):
+        member: Member = await dbio.get_member(message.from_user, self.group)
         rm = message.reply_to_message
         if not rm:
             raise OperationError("没有回复消息")
-        mr: Message = Message.get_or_none(mid=rm.id, member=member)
-        if not mr:
-            rmr = RedirectedMessage.get_or_none(mid=rm.id, to_member=member)
-            if rmr:
-                mr: Message = rmr.message
-            else:
-                if allow_pm:
-                    pmm: PMMessage = PMMessage.get_or_none(redirected_mid=rm.id, to_member=member)
-                    if pmm:
-                        mr: PMMessage = pmm
-                    else:
-                        raise OperationError("这不是匿名消息或已过时")
-                else:
-                    raise OperationError("这不是匿名消息或已过时")
+        mr: Union[Message, PMMessage] = await dbio.resolve_reply(member, rm.id)
+        if not mr or (isinstance(mr, PMMessage) and not allow_pm):
+            raise OperationError("这不是匿名消息或已过时")
         return member, mr
 
     @operation(MemberRole.MEMBER)
     async def on_delete(self: "anonyabbot.GroupBot", client: Client, message: TM):
         await message.delete()
         info = async_partial(self.info, context=message)
-        member, mr = self.get_member_reply_message(message)
+        member, mr = await self.get_member_reply_message(message)
         member.check_ban(BanType.MESSAGE)
         if not mr.member.id == member.id:
             if not member.validate(MemberRole.ADMIN_BAN):
@@ -70,7 +61,7 @@ class OnCommand:
     async def on_change(self: "anonyabbot.GroupBot", client: Client, message: TM):
         await message.delete()
         info = async_partial(self.info, context=message)
-        member: Member = message.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(message.from_user, self.group)
         _, mask = await self.unique_mask_pool.get_mask(member, renew=True)
         await info(f"🌈 你的面具已更改为: {mask}")
 
@@ -78,7 +69,7 @@ class OnCommand:
     async def on_setmask(self: "anonyabbot.GroupBot", client: Client, message: TM):
         await message.delete()
         info = async_partial(self.info, context=message)
-        member: Member = message.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(message.from_user, self.group)
         if not member.validate(MemberRole.ADMIN):
             if not member.user.is_prime:
                 await info(f"⚠️ 您需要 [PRIME](t.me/anonycnbot?start=_createcode) 特权以使用该功能.")
@@ -99,21 +90,21 @@ class OnCommand:
         try:
             _, uid = cmd
         except ValueError:
-            member, mr = self.get_member_reply_message(message, allow_pm=True)
+            member, mr = await self.get_member_reply_message(message, allow_pm=True)
             if isinstance(mr, Message):
                 target = mr.member
             elif isinstance(mr, PMMessage):
                 target = mr.from_member
                 pmban = PMBan.get_or_none(from_member=target, to_member=member)
                 if not pmban:
-                    PMBan.create(from_member=target, to_member=member)
+                    await dbio.io.write(PMBan.create, from_member=target, to_member=member)
                 return await info("✅ 该成员给您发的私信将被屏蔽")
         else:
             user = await self.bot.get_users(uid)
-            target = user.get_member(self.group)
+            target = await dbio.get_member(user, self.group)
             if not target:
                 raise OperationError("成员已不在群组中")
-            member: Member = message.from_user.get_member(self.group)
+            member: Member = await dbio.get_member(message.from_user, self.group)
         member.validate(MemberRole.ADMIN_BAN)
         if target.role >= MemberRole.ADMIN:
             member.validate(MemberRole.ADMIN_ADMIN, fail=True)
@@ -127,7 +118,8 @@ class OnCommand:
             return await info("⚠️ 该成员本就处于封禁状态")
 
         target.role = MemberRole.BANNED
-        target.save()
+        await dbio.save(target)
+        self.recipient_set.update(target)
         return await info("🚫 成员已封禁")
 
     @operation()
@@ -139,21 +131,21 @@ class OnCommand:
         try:
             _, uid = cmd
         except ValueError:
-            member, mr = self.get_member_reply_message(message, allow_pm=True)
+            member, mr = await self.get_member_reply_message(message, allow_pm=True)
             if isinstance(mr, Message):
                 target = mr.member
             elif isinstance(mr, PMMessage):
                 target = mr.from_member
                 pmban = PMBan.get_or_none(from_member=target, to_member=member)
                 if pmban:
-                    pmban.delete_instance()
+                    await dbio.io.write(pmban.delete_instance)
                 return await info("✅ 此成员现在可以发送私人消息给您了")
         else:
             user = await self.bot.get_users(uid)
-            target = user.get_member(self.group)
+            target = await dbio.get_member(user, self.group)
             if not target:
                 raise OperationError("成员已不在群组中")
-            member: Member = message.from_user.get_member(self.group)
+            member: Member = await dbio.get_member(message.from_user, self.group)
         member.validate(MemberRole.ADMIN_BAN)
         if target.role >= MemberRole.ADMIN:
             member.validate(MemberRole.ADMIN_ADMIN, fail=True)
@@ -168,20 +160,21 @@ class OnCommand:
 
 
         target.role = MemberRole.GUEST
-        target.save()
+        await dbio.save(target)
+        self.recipient_set.update(target)
         return await info("✅ 成员已解封")
 
     @operation(MemberRole.ADMIN_MSG)
     async def on_pin(self: "anonyabbot.GroupBot", client: Client, message: TM):
         await message.delete()
         info = async_partial(self.info, context=message)
-        user: User = message.from_user.get_record()
+        user: User = await dbio.get_record(message.from_user)
         if (not self.group.is_prime) and (not user.is_prime):
             await info(f"⚠️ 您或该群组创建者没有 [PRIME](t.me/anonycnbot?start=_createcode) 特权, 因此不能使用该功能.")
             return
-        member, mr = self.get_member_reply_message(message)
+        member, mr = await self.get_member_reply_message(message)
         mr.pinned = True
-        mr.save()
+        await dbio.io.write_shard(mr.save)
         e = asyncio.Event()
         op = PinOperation(member=member, finished=e, message=mr)
         await self.queue.put(op)
@@ -209,9 +202,9 @@ class OnCommand:
         if not self.group.is_prime:
             await info(f"⚠️ 该群组创建者没有 [PRIME](t.me/anonycnbot?start=_createcode) 特权, 因此不能使用该功能.")
             return
-        member, mr = self.get_member_reply_message(message)
+        member, mr = await self.get_member_reply_message(message)
         mr.pinned = False
-        mr.save()
+        await dbio.io.write_shard(mr.save)
         e = asyncio.Event()
         op = UnpinOperation(member=member, finished=e, message=mr)
         await self.queue.put(op)
@@ -236,7 +229,7 @@ class OnCommand:
     async def on_reveal(self: "anonyabbot.GroupBot", client: Client, message: TM):
         await message.delete()
         info = async_partial(self.info, context=message)
-        _, mr = self.get_member_reply_message(message)
+        _, mr = await self.get_member_reply_message(message)
         target: Member = mr.member
         msg = (
             f"ℹ️ 此成员的信息:\n\n"
@@ -245,7 +238,7 @@ class OnCommand:
             f"群组中的角色: {target.role.display.title()}\n"
             f"加入日期: {target.created.strftime('%Y-%m-%d')}\n"
             f"消息总数: {target.n_messages}\n"
-            f"最近活跃: {target.last_activity.strftime('%Y-%m-%d')}\n"
+            f"最近活跃: {target.last_active.strftime('%Y-%m-%d')}\n"
             f"最近面具: {target.last_mask}\n\n"
             f"👁️‍🗨️ 这个面板仅对您可见"
         )
@@ -254,7 +247,7 @@ class OnCommand:
     @operation(MemberRole.ADMIN_BAN)
     async def on_manage(self: "anonyabbot.GroupBot", client: Client, message: TM):
         await message.delete()
-        _, mr = self.get_member_reply_message(message)
+        _, mr = await self.get_member_reply_message(message)
         target: Member = mr.member
         return await self.to_menu_scratch("_member_detail", message.chat.id, message.from_user.id, member_id=target.id)
 
@@ -265,7 +258,7 @@ class OnCommand:
         content = message.text or message.caption
         
         try:
-            member, mr = self.get_member_reply_message(message, allow_pm=True)
+            member, mr = await self.get_member_reply_message(message, allow_pm=True)
             if isinstance(mr, Message):
                 target: Member = mr.member
             elif isinstance(mr, PMMessage):
@@ -316,7 +309,7 @@ class OnCommand:
             await msg.delete()
             return
         else:
-            PMMessage.create(from_member=member, to_member=target, mid=message.id, redirected_mid=masked_message.id)
+            await dbio.create_pm_message(from_member=member, to_member=target, mid=message.id, redirected_mid=masked_message.id)
             await msg.edit('✅ 私信已发送')
             await asyncio.sleep(5)
             await msg.delete()
@@ -350,7 +343,7 @@ class OnCommand:
         await context.delete()
         if not self.group.private:
             raise OperationError('该群组是公开群组, 不需要邀请链接')
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         member.check_ban(BanType.INVITE, fail=True)
         return '❓ 生成的邀请链接可以使用多少次?'
     
@@ -402,7 +395,7 @@ class OnCommand:
         context: TC,
         parameters: dict,
     ):
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         member.check_ban(BanType.INVITE, fail=True)
         t = parameters["i_select_time_id"]
         if t == "无限":
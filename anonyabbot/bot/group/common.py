@@ -7,6 +7,7 @@ from pyrogram.types import Message as TM, CallbackQuery as TC
 from pyrogram.errors import UserDeactivated, MessageNotModified
 
 import anonyabbot
+from ... import dbio
 from ...utils import nonblocking
 from ...model import OperationError, MemberRole, Member, User
 
@@ -33,13 +34,14 @@ def operation(req: MemberRole = MemberRole.GUEST, conversation=False, allow_disa
                     if (not allow_disabled) and self.group.disabled:
                         raise OperationError("此群组已被删除, 无法进行操作")
                     if req:
-                        member: Member = context.from_user.get_member(self.group)
+                        member: Member = await dbio.get_member(context.from_user, self.group)
                         if not member:
                             raise OperationError("您不在此群组中")
-                        member.validate(req, fail=True)
+                        await dbio.validate(member, req, fail=True)
                         member.touch()
+                        self.recipient_set.touch(member)
                     if not concurrency == 'inf':
-                        user: User = context.from_user.get_record()
+                        user: User = await dbio.get_record(context.from_user)
                         async with self.lock:
                             if not user in self.user_locks:
                                 self.user_locks[user] = asyncio.Lock()
@@ -76,7 +78,7 @@ def operation(req: MemberRole = MemberRole.GUEST, conversation=False, allow_disa
             except UserDeactivated as e:
                 if self.group:
                     self.group.disabled = True
-                    self.group.save()
+                    await dbio.save(self.group)
                 self.failed.set()
                 logger.info(f"Group @{client.me.username} disabled because token deactivated.")
 
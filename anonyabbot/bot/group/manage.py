@@ -7,6 +7,7 @@ from pyrubrum import Element
 
 import anonyabbot
 
+from ... import dbio
 from ...utils import async_partial, truncate_str, parse_timedelta
 from ...model import Member, db, MemberRole, BanType, BanGroup
 from .common import operation
@@ -36,7 +37,7 @@ class Manage:
         parameters: dict,
     ):
         group = self.group
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         creator = group.creator.markdown if member.role >= MemberRole.ADMIN_BAN else group.creator.masked_name
         waiting_delay = f"{self.worker_status['time'] / self.worker_status['requests']:.1f} 秒" if self.worker_status['requests'] else "无数据"
         msg = f"ℹ️ 群组信息: \n\n"
@@ -46,9 +47,10 @@ class Manage:
             f"成员数: {group.n_members}",
             f"消息数: {group.n_messages}",
             f"平均传播延迟: {waiting_delay}",
+            f"发送速率: {self.limiter.rate:.1f}/秒 (排队 {self.limiter.backlog})",
             f"禁用: {'**是**' if group.disabled else '否'}",
             f"创建时间: {group.created.strftime('%Y-%m-%d')}",
-            f"最后活动时间: {group.last_activity.strftime('%Y-%m-%d')}",
+            f"最后活动时间: {group.last_active.strftime('%Y-%m-%d')}",
         ]
         msg += indent("\n".join(fields), "  ")
         return msg
@@ -108,11 +110,15 @@ class Manage:
     ):
         current_selection = parameters.get("edbg_current", [])
         types = [BanType(v) for v in current_selection]
-        with db.atomic():
-            original = self.group.default_ban_group
-            self.group.default_ban_group = BanGroup.generate(types)
-            self.group.save()
-            original.delete_instance()
+
+        def replace():
+            with db.atomic():
+                original = self.group.default_ban_group
+                self.group.default_ban_group = BanGroup.generate(types)
+                self.group.save()
+                original.delete_instance()
+
+        await dbio.io.write(replace)
         await context.answer("✅ 成功")
         await self.to_menu("_group_details", context)
 
@@ -227,7 +233,7 @@ class Manage:
         status = not parameters.get("show_latest_message", self.group.welcome_latest_messages)
         parameters["show_latest_message"] = status
         self.group.welcome_latest_messages = status
-        self.group.save()
+        await dbio.save(self.group)
         await context.answer('✅ 成功')
         await self.to_menu('group_entering', context)
 
@@ -242,7 +248,7 @@ class Manage:
         button_spec = parameters["button_spec"]
         test_message_id = parameters["text_message"]
         self.group.welcome_message_buttons = button_spec
-        self.group.save()
+        await dbio.save(self.group)
         await self.bot.delete_messages(self.group.username, test_message_id)
         m = await self.bot.send_message(context.message.chat.id, "✅ 成功")
         await asyncio.sleep(5)
@@ -392,7 +398,7 @@ class Manage:
             f"群组中的权限角色：{target.role.display.title()}\n"
             f"加入日期：{target.created.strftime('%Y-%m-%d')}\n"
             f"消息数：{target.n_messages}\n"
-            f"最后活动时间：{target.last_activity.strftime('%Y-%m-%d')}\n"
+            f"最后活动时间：{target.last_active.strftime('%Y-%m-%d')}\n"
             f"最后一次发信使用的面具：{target.last_mask}\n\n"
             + (f"邀请人: {target.invitor.user.markdown}\n\n" if target.invitor else "")
             + f"👁️‍🗨️ 这个面板仅对您可见"
@@ -422,7 +428,7 @@ class Manage:
     ):
         role = MemberRole(int(parameters["edit_member_role_id"]))
         target: Member = Member.get_by_id(parameters["member_id"])
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         if target.role >= MemberRole.ADMIN or role >= MemberRole.ADMIN:
             member.validate(MemberRole.ADMIN_ADMIN, fail=True)
         if target.role >= MemberRole.ADMIN_ADMIN:
@@ -434,7 +440,8 @@ class Manage:
             await context.answer("⚠️ 无法编辑权限高于您的成员", show_alert=True)
             await self.to_menu("_member_detail", context)
         target.role = role
-        target.save()
+        await dbio.save(target)
+        self.recipient_set.update(target)
         await context.answer("✅ 修改成功")
         await self.to_menu("_member_detail", context)
 
@@ -465,7 +472,7 @@ class Manage:
             current_selection = None
         if not current_selection:
             if target.ban_group:
-                parameters["embg_current"] = current_selection = [t.type.value for t in target.ban_group.entries.iterator()]
+                parameters["embg_current"] = current_selection = [t.value for t in target.ban_group.types()]
             else:
                 parameters["embg_current"] = current_selection = [t.value for t in self.group.default_bans()]
 
@@ -518,7 +525,7 @@ class Manage:
         parameters: dict,
     ):
         target: Member = Member.get_by_id(parameters["member_id"])
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         if target.role >= MemberRole.ADMIN:
             member.validate(MemberRole.ADMIN_ADMIN, fail=True)
         if target.role >= MemberRole.ADMIN_ADMIN:
@@ -535,12 +542,17 @@ class Manage:
         td = parse_timedelta(td_str)
         until = datetime.now() + td
         types = [BanType(v) for v in current_selection]
-        with db.atomic():
-            original = target.ban_group
-            target.ban_group = BanGroup.generate(types, until=until)
-            target.save()
-            if original:
-                original.delete_instance()
+
+        def replace():
+            with db.atomic():
+                original = target.ban_group
+                target.ban_group = BanGroup.generate(types, until=until)
+                target.save()
+                if original:
+                    original.delete_instance()
+
+        await dbio.io.write(replace)
+        self.recipient_set.update(target)
         await context.answer("✅ 修改成功")
         await self.to_menu("_member_detail", context)
 
@@ -568,7 +580,7 @@ class Manage:
         parameters: dict,
     ):
         target: Member = Member.get_by_id(parameters["member_id"])
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         if target.role >= MemberRole.ADMIN:
             member.validate(MemberRole.ADMIN_ADMIN, fail=True)
         if target.role >= MemberRole.ADMIN_ADMIN:
@@ -580,7 +592,8 @@ class Manage:
             await context.answer("⚠️ 无法编辑权限高于您的成员", show_alert=True)
             await self.to_menu("_member_detail", context)
         target.role = MemberRole.BANNED
-        target.save()
+        await dbio.save(target)
+        self.recipient_set.update(target)
         await context.answer("✅ 编辑成功")
         await self.to_menu("list_group_members", context)
 
@@ -643,7 +656,7 @@ class Manage:
         status = not parameters.get("group_privacy", self.group.private)
         parameters["group_privacy"] = status
         self.group.private = status
-        self.group.save()
+        await dbio.save(self.group)
         await context.answer('✅ 成功')
         await self.to_menu('group_entering', context)
     
@@ -695,6 +708,54 @@ class Manage:
             self.group.inactive_leave = 0
         else:
             self.group.inactive_leave = int(r)
-        self.group.save()
+        await dbio.save(self.group)
+        self.recipient_set.invalidate()
+        await context.answer('✅ 成功')
+        await self.to_menu('group_other_settings', context)
+
+    @operation(MemberRole.ADMIN_ADMIN)
+    async def button_edit_retention(
+        self: "anonyabbot.GroupBot",
+        handler,
+        client: Client,
+        context: TC,
+        parameters: dict,
+    ):
+        return "消息保留时间 " + (f"({self.group.retention_days} 天)" if self.group.retention_days else "(默认)")
+
+    @operation(MemberRole.ADMIN_ADMIN)
+    async def on_edit_retention(
+        self: "anonyabbot.GroupBot",
+        handler,
+        client: Client,
+        context: TC,
+        parameters: dict,
+    ):
+        return 'ℹ️ 消息记录保留多少天? 超过该时间的消息将无法被编辑, 删除或回复 (置顶消息和被回复的消息除外).'
+
+    @operation(MemberRole.ADMIN_ADMIN)
+    async def items_edit_retention(
+        self: "anonyabbot.GroupBot",
+        handler,
+        client: Client,
+        context: TC,
+        parameters: dict,
+    ):
+        return [Element(str(i), str(i)) for i in ["默认", 7, 30, 90, 365]]
+
+    @operation(MemberRole.ADMIN_ADMIN)
+    async def on_ert_done(
+        self: "anonyabbot.GroupBot",
+        handler,
+        client: Client,
+        context: TC,
+        parameters: dict,
+    ):
+        r = parameters["ert_done_id"]
+        if r == "默认":
+            self.group.retention_days = None
+        else:
+            self.group.retention_days = int(r)
+        await dbio.save(self.group)
         await context.answer('✅ 成功')
         await self.to_menu('group_other_settings', context)
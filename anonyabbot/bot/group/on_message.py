@@ -8,8 +8,9 @@ from pyrogram.enums import MessageEntityType
 
 import anonyabbot
 
+from ... import dbio
 from ...utils import async_partial
-from ...model import Member, BanType, MemberRole, Message, PMMessage, RedirectedMessage, OperationError, User
+from ...model import Member, BanType, MemberRole, Message, PMMessage, OperationError, User
 from .common import operation
 from .mask import MaskNotAvailable
 from .worker import BroadcastOperation, EditOperation
@@ -90,7 +91,7 @@ class OnMessage:
                         else:
                             content = message.text
                         self.group.welcome_message = content
-                        self.group.save()
+                        await dbio.save(self.group)
                         await info(f"✅ 成功")
                     elif message.photo:
                         if message.caption == "disable":
@@ -99,7 +100,7 @@ class OnMessage:
                             content = message.caption
                         self.group.welcome_message = content
                         self.group.welcome_message_photo = message.photo.file_id
-                        self.group.save()
+                        await dbio.save(self.group)
                         await info(f"✅ 成功")
                     else:
                         await info(f"⚠️ 不是有效的消息")
@@ -110,7 +111,7 @@ class OnMessage:
                     else:
                         if content == "disable":
                             content = None
-                        user: User = message.from_user.get_record()
+                        user: User = await dbio.get_record(message.from_user)
                         try:
                             tm = await self.send_welcome_msg(
                                 user=user,
@@ -131,7 +132,7 @@ class OnMessage:
                         if content == "disable":
                             content = None
                         self.group.chat_instruction = content
-                        self.group.save()
+                        await dbio.save(self.group)
                         await info(f"✅ 成功")
                 elif conv.status == "ep_password":
                     content = message.text or message.caption
@@ -141,7 +142,7 @@ class OnMessage:
                         if content == "disable":
                             content = None
                         self.group.password = content
-                        self.group.save()
+                        await dbio.save(self.group)
                         await info(f"✅ 成功")
                 elif conv.status == "gp_password":
                     event, container = conv.data
@@ -161,7 +162,7 @@ class OnMessage:
                     if not content:
                         await info(f"⚠️ 不是有效的消息")
                     else:
-                        member: Member = message.from_user.get_member(self.group)
+                        member: Member = await dbio.get_member(message.from_user, self.group)
                         if not member:
                             return
                         try:
@@ -188,7 +189,7 @@ class OnMessage:
                             await conv.data.delete()
                         else:
                             member.pinned_mask = m
-                            member.save()
+                            await dbio.save(member)
                             await info(f"✅ 成功, 您将固定使用 {m} 作为面具.")
                             await conv.data.delete()
             finally:
@@ -200,7 +201,7 @@ class OnMessage:
                 self.set_conversation(conv.context, None)
                 return
         try:
-            member: Member = message.from_user.get_member(self.group)
+            member: Member = await dbio.get_member(message.from_user, self.group)
             if not member:
                 raise OperationError("您不在该群组中, 请尝试使用 /start 加入.")
             self.check_message(message, member)
@@ -225,7 +226,8 @@ class OnMessage:
                     await message.delete()
                     return
             member.role = MemberRole.MEMBER
-            member.save()
+            await dbio.save(member)
+            self.recipient_set.update(member)
 
         if member.pinned_mask:
             mask = member.pinned_mask
@@ -241,22 +243,16 @@ class OnMessage:
         rm = message.reply_to_message
         
         if rm:
-            rmm: Message = Message.get_or_none(mid=rm.id, member=member)
-            if not rmm:
-                rmr = RedirectedMessage.get_or_none(mid=rm.id, to_member=member)
-                if rmr:
-                    rmm: Message = rmr.message
-                else:
-                    pmm: PMMessage = PMMessage.get_or_none(redirected_mid=rm.id, to_member=member)
-                    if pmm:
-                        await self.pm(message)
-                        return
+            rmm: Message = await dbio.resolve_reply(member, rm.id)
+            if isinstance(rmm, PMMessage):
+                await self.pm(message)
+                return
         else:
             rmm = None
                 
-        m = Message.create(group=self.group, mid=message.id, member=member, mask=mask, reply_to=rmm)
+        m = await dbio.create_message(group=self.group, mid=message.id, member=member, mask=mask, reply_to=rmm)
         member.last_mask = mask
-        member.save()
+        await dbio.save(member)
 
         e = asyncio.Event()
         op = BroadcastOperation(context=message, member=member, finished=e, message=m)
@@ -267,7 +263,7 @@ class OnMessage:
             msg: TM = await info("🔃 消息正在发送...", time=None)
         
         await self.queue.put(op)
-        n_members = self.group.n_members
+        n_members = await dbio.n_members(self.group)
         for i in range(30 + 5 * n_members):
             try:
                 await asyncio.wait_for(e.wait(), 1)
@@ -291,10 +287,10 @@ class OnMessage:
 
     @operation(req=None, conversation=True, allow_disabled=True)
     async def on_edit_message(self: "anonyabbot.GroupBot", client: Client, message: TM):
-        member: Member = message.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(message.from_user, self.group)
         if not member:
             return
-        mr = Message.get_or_none(mid=message.id)
+        mr = await dbio.get_or_none(Message, mid=message.id)
         if not mr:
             return
         e = asyncio.Event()
@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import time
+from typing import Dict, Iterator
+
+from ...model import BanGroup, BanType, Group, Member, MemberRole, User, UserRole, Validation
+
+
+@dataclass
+class Recipient:
+    member: Member
+    receive: bool
+    until: datetime = None
+
+
+class RecipientSet:
+    """
+    Members of a group who are able to receive messages, kept in memory.
+    Note:
+        The set is rebuilt from the database when it is older than ttl seconds or invalidated,
+        and members are updated one by one when their role or ban group changes.
+    """
+
+    def __init__(self, ttl: int = 600):
+        self.ttl = ttl
+        self.group: Group = None
+        self.entries: Dict[int, Recipient] = {}
+        self.built = None
+
+    def invalidate(self):
+        self.built = None
+
+    def rebuild(self, group: Group):
+        now = datetime.now()
+        creators = {
+            v.user_id
+            for v in Validation.select(Validation.user).where(
+                Validation.role == UserRole.CREATOR, (Validation.until > now) | (Validation.until.is_null())
+            )
+        }
+        members = Member.select(Member, User).join(User).where(Member.group == group, Member.role >= MemberRole.GUEST)
+        restricted = {
+            g.id
+            for g in BanGroup.select(BanGroup.id).where(
+                BanGroup.mask.bin_and(BanGroup.bit(BanType.RECEIVE)) != 0, BanGroup.id << members.select(Member.ban_group)
+            )
+        }
+        entries = {}
+        m: Member
+        for m in members.order_by(Member.id).iterator():
+            m.group = group
+            entry = self.entry(m, m.user_id in creators, m.ban_group_id in restricted)
+            if entry:
+                entries[m.id] = entry
+        self.group = group
+        self.entries = entries
+        self.built = time.monotonic()
+
+    def entry(self, member: Member, creator: bool, restricted: bool):
+        role = member.role
+        if creator and role < MemberRole.ADMIN_ADMIN:
+            role = MemberRole.ADMIN_ADMIN
+        if role <= MemberRole.BANNED:
+            return None
+        until = None
+        if self.group_of(member).inactive_leave and role < MemberRole.ADMIN:
+            until = member.last_active + timedelta(days=self.group_of(member).inactive_leave)
+        return Recipient(member=member, receive=role >= MemberRole.ADMIN or not restricted, until=until)
+
+    def group_of(self, member: Member):
+        return self.group if self.group and member.group_id == self.group.id else member.group
+
+    def update(self, member: Member):
+        """Recompute the entry of a member after its role or ban group is changed."""
+        if self.built is None or member.group_id != self.group.id:
+            return
+        entry = None
+        if member.role >= MemberRole.GUEST:
+            ban_group = BanGroup.cached(member.ban_group_id)
+            restricted = bool(ban_group and ban_group.has(BanType.RECEIVE))
+            entry = self.entry(member, member.user.validate(UserRole.CREATOR), restricted)
+        if entry:
+            self.entries[member.id] = entry
+        else:
+            self.entries.pop(member.id, None)
+
+    def touch(self, member: Member):
+        """Move the inactivity deadline of a member after it is active."""
+        entry = self.entries.get(member.id, None)
+        if entry and entry.until:
+            entry.until = member.last_active + timedelta(days=self.group.inactive_leave)
+
+    def members(self, group: Group, exclude: Member = None, check_receive=True) -> Iterator[Member]:
+        if self.built is None or self.group.id != group.id or time.monotonic() - self.built > self.ttl:
+            self.rebuild(group)
+        now = datetime.now()
+        for entry in list(self.entries.values()):
+            if exclude and entry.member.id == exclude.id:
+                continue
+            if entry.until and entry.until < now:
+                continue
+            if check_receive and not entry.receive:
+                continue
+            yield entry.member
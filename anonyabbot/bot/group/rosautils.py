@@ -120,14 +120,28 @@ def change_vague(wav, sr=_sr, rate=1):
     return librosa.istft(D)
 
 
-class CheckStep(object):
-    def __init__(self, step):
-        self.step = step
-        self.index = 0
-
-    def __call__(self, *args):
-        self.index += 1
-        return self.index % self.step != 0
+def stream(blocks, overlap, effect):
+    """
+    分块处理长音频，相邻块的重叠部分交叉淡化(overlap-add)。
+    :param blocks:音频块，每块的开头与上一块的结尾重叠overlap个采样点
+    :param overlap:重叠的采样点数
+    :param effect:处理函数，输入输出等长的音频
+    :return:逐段产出处理后的音频
+    """
+    fade = np.linspace(0, 1, overlap, dtype=np.float32)
+    tail = None
+    for b in blocks:
+        y = librosa.util.fix_length(effect(b), size=len(b)).astype(np.float32, copy=False)
+        if tail is not None:
+            n = min(len(tail), len(y))
+            y[:n] = tail[:n] * (1 - fade[:n]) + y[:n] * fade[:n]
+        if len(y) > overlap:
+            yield y[:-overlap]
+            tail = y[-overlap:]
+        else:
+            tail = y
+    if tail is not None:
+        yield tail
 
 
 def spread(D, size=(3, 3)):
@@ -175,24 +189,23 @@ def roll(D, n):
 
 def rewardshape(D, shape):
     """填充"""
-    x = shape[0] - D.shape[0]
-    y = shape[1] - D.shape[1]
-    if x > 0:
-        bottomlist = np.zeros([x, D.shape[1]])
-        D = np.r_[D, bottomlist]
-    if y > 0:
-        rightlist = np.zeros([D.shape[0], y])
-        D = np.c_[D, rightlist]
-    return D
+    rows = max(shape[0], D.shape[0])
+    cols = max(shape[1], D.shape[1])
+    if (rows, cols) == D.shape:
+        return D
+    R = np.zeros((rows, cols), dtype=np.result_type(D, 0.0))
+    R[:D.shape[0], :D.shape[1]] = D
+    return R
 
 
 def pool_step(D, step):
     """步长池化"""
-    _shape = D.shape
     if step < 2:
         return D
-    cs = CheckStep(step)
-    return rewardshape(np.array(list(filter(cs, D))), _shape)
+    keep = np.arange(1, D.shape[0] + 1) % step != 0
+    R = np.zeros(D.shape, dtype=np.result_type(D, 0.0))
+    np.compress(keep, D, axis=0, out=R[:np.count_nonzero(keep)])
+    return R
 
 
 def pool(D, size=(3, 3), shapeed=False):
@@ -200,24 +213,16 @@ def pool(D, size=(3, 3), shapeed=False):
     _shape = D.shape
     if isinstance(size, tuple):
         if size[1] > 1:
-            D = _pool(D, size[1])
+            D = _pool(D, size[1], axis=1)
         if size[0] > 1:
-            D = _pool(D.T, size[0]).T
+            D = _pool(D, size[0], axis=0)
     elif isinstance(size, int):
-        D = _pool(D.T, size).T
+        D = _pool(D, size, axis=0)
     if shapeed:
         D = rewardshape(D, _shape)
     return D
 
 
-def _pool(D, poolsize):
+def _pool(D, poolsize, axis=1):
     """池化方法"""
-    x = D.shape[1] // poolsize
-    restsize = D.shape[1] % poolsize
-    if restsize > 0:
-        x += 1
-        rightlist = np.zeros([D.shape[0], poolsize - restsize])
-        D = np.c_[D, rightlist]
-    D = D.reshape((-1, poolsize))
-    D = D.sum(axis=1).reshape(-1, x)
-    return D
+    return np.add.reduceat(D, np.arange(0, D.shape[axis], poolsize), axis=axis)
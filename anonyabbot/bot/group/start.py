@@ -5,6 +5,7 @@ from pyrogram.errors import PeerIdInvalid
 
 import anonyabbot
 
+from ... import dbio
 from ...model import BanType, Member, User, MemberRole
 from ...utils import async_partial, remove_prefix
 from .worker import BulkRedirectOperation, BulkPinOperation
@@ -61,7 +62,8 @@ class Start:
             nrpm = member.not_redirected_pinned_messages()
             if len(nrpm) > 0:
                 e = asyncio.Event()
-                op = BulkRedirectOperation(messages=reversed(nrpm), member=member, finished=e)
+                # Pinned messages are out of order, so they do not move the delivery cursor.
+                op = BulkRedirectOperation(messages=reversed(nrpm), member=member, finished=e, advance=False)
                 info = async_partial(self.info, context=context)
                 msg: TM = await info(f"🔃 加载置顶消息 ...", time=None)
                 await self.queue.put(op)
@@ -84,7 +86,8 @@ class Start:
                     await asyncio.sleep(3)
                 await msg.delete()
                 
-            nrm = member.not_redirected_messages()
+            pinned = {m.id for m in nrpm}
+            nrm = [m for m in member.not_redirected_messages() if m.id not in pinned]
             if len(nrm) > 0:
                 e = asyncio.Event()
                 op = BulkRedirectOperation(messages=reversed(nrm), member=member, finished=e)
@@ -173,8 +176,8 @@ class Start:
             else:
                 return True
         
-        member: Member = context.from_user.get_member(self.group)
-        user: User = context.from_user.get_record()
+        member: Member = await dbio.get_member(context.from_user, self.group)
+        user: User = await dbio.get_record(context.from_user)
         if member:
             if isinstance(context, TM):
                 await context.delete()
@@ -182,7 +185,8 @@ class Start:
             if member.role == MemberRole.LEFT:
                 if await check(self, member, context):
                     member.role = MemberRole.GUEST
-                    member.save()
+                    await dbio.save(member)
+                    self.recipient_set.update(member)
                     await welcome(self, user, member, context)
             else:
                 return (
@@ -197,7 +201,8 @@ class Start:
                 )
         else:
             if await check(self, member, context):
-                member = Member.create(group=self.group, user=user, role=MemberRole.GUEST)
+                member = await dbio.io.write(Member.create, group=self.group, user=user, role=MemberRole.GUEST)
+                self.recipient_set.update(member)
                 await welcome(self, user, member, context)
 
     @operation()
@@ -208,7 +213,7 @@ class Start:
         context: TC,
         parameters: dict,
     ):
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         if member.role == MemberRole.CREATOR:
             await context.answer("⚠️ Creator of the group cannot leave.", show_alert=True)
             await self.to_menu("start", context)
@@ -223,9 +228,10 @@ class Start:
         context: TC,
         parameters: dict,
     ):
-        member: Member = context.from_user.get_member(self.group)
+        member: Member = await dbio.get_member(context.from_user, self.group)
         member.role = MemberRole.LEFT
-        member.save()
+        await dbio.save(member)
+        self.recipient_set.update(member)
         await context.answer("✅ 您已退出群组, 将不再收到消息.", show_alert=True)
         await asyncio.sleep(2)
         await context.message.delete()
@@ -51,6 +51,7 @@ class Tree:
                 P("list_group_members", "👤 成员列表", extras=["_lgm_switch_activity", "_lgm_switch_role"]): {M("jump_member_detail")},
                 M("group_other_settings", "💫 更多设置", "⬇️ 点击下方按钮以配置群组:", per_line=1): {
                     K("edit_inactive_leave"): {M("eil_done"): None,},
+                    K("edit_retention"): {M("ert_done"): None,},
                 },
                 M("close_group_details", "❌ 关闭"): None,
             },
@@ -0,0 +1,121 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import multiprocessing
+import random
+import time
+from typing import Tuple
+
+import librosa
+from loguru import logger
+
+from ...config import config
+from . import codec
+from . import rosautils as _r
+
+# Seconds of audio per block and of overlap between blocks in streaming mode.
+STREAM_BLOCK = 10
+STREAM_OVERLAP = 0.5
+
+
+def transform(data: bytes, sr: int = None, stream_threshold: float = 60) -> Tuple[bytes, int, float]:
+    """Anonymize an ogg voice, returns the ogg voice, its duration and the cpu time used."""
+    start = time.process_time()
+    pitch = random.choice([-3, 3])
+    male = random.choice([600, 900])
+
+    def effect(obj, sr):
+        # The inverse stft trims the tail, pad it back so that streamed and whole voices have the same length.
+        size = len(obj)
+        obj = _r.change_pitch(obj, sr, pitch)
+        return librosa.util.fix_length(_r.change_male(obj, sr, male), size=size)
+
+    info = codec.info(data)
+    if stream_threshold and info.duration > stream_threshold:
+        # Long voices are processed in overlapping blocks to keep memory bounded.
+        sr = sr or info.samplerate
+        encoder = codec.Encoder(sr)
+        blocks = codec.blocks(data, STREAM_BLOCK, STREAM_OVERLAP, sr=sr)
+        for obj in _r.stream(blocks, int(STREAM_OVERLAP * sr), lambda b: effect(b, sr)):
+            encoder.write(obj)
+        return encoder.close(), int(info.duration), time.process_time() - start
+    obj, sr = codec.decode(data, sr=sr)
+    obj = effect(obj, sr)
+    duration = int(len(obj) / sr)
+    return codec.encode(obj, sr), duration, time.process_time() - start
+
+
+class VoiceBusy(Exception):
+    pass
+
+
+class VoiceService:
+    """Run voice transformations in a process pool shared by all group bots."""
+
+    def __init__(self):
+        self.executor = None
+        self.slots = None
+        self.pending = 0
+        self.jobs = 0
+        self.cpu_time = 0.0
+
+    @property
+    def workers(self):
+        return config.get("voice.workers", 2)
+
+    @property
+    def timeout(self):
+        return config.get("voice.timeout", 120)
+
+    @property
+    def status(self):
+        return {
+            "pending": self.pending,
+            "jobs": self.jobs,
+            "cpu_time": self.cpu_time,
+        }
+
+    def start(self):
+        if not self.executor:
+            # The pool is created lazily when threads already exist, so workers must not be forked from this process.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            self.slots = asyncio.Semaphore(self.workers + config.get("voice.queue", 8))
+
+    def release(self):
+        self.pending -= 1
+        self.slots.release()
+
+    async def transform(self, data: bytes) -> Tuple[BytesIO, int]:
+        self.start()
+        # Wait for a free slot for a while, instead of failing as soon as the queue is full.
+        try:
+            await asyncio.wait_for(self.slots.acquire(), config.get("voice.wait", 60))
+        except asyncio.TimeoutError:
+            raise VoiceBusy("voice processing queue is full") from None
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        try:
+            job = self.executor.submit(
+                transform,
+                data,
+                config.get("voice.sample_rate", None),
+                config.get("voice.stream_threshold", 60),
+            )
+        except BaseException:
+            self.release()
+            raise
+        # The slot is held until the job ends in its process, as a running job is not stopped by a timeout.
+        job.add_done_callback(lambda _: loop.is_closed() or loop.call_soon_threadsafe(self.release))
+        # Jobs still waiting for a process are dropped on timeout or cancellation.
+        result, duration, cpu_time = await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+        self.jobs += 1
+        self.cpu_time += cpu_time
+        logger.debug(f"Voice transformed in {cpu_time:.2f}s cpu time ({self.pending} pending).")
+        f_ogg = BytesIO(result)
+        f_ogg.name = "tmp.ogg"
+        return f_ogg, duration
+
+
+service = VoiceService()
@@ -1,25 +1,22 @@
 import asyncio
-import copy
 from dataclasses import dataclass, field
 from datetime import datetime
 from io import BytesIO
-import random
-from typing import List
+from typing import Awaitable, Callable, Iterable, List, Set, Tuple, Union
 
 import emoji
-import librosa
-import soundfile as sf
-from pydub import AudioSegment
 from pyrogram.types import Message as TM, MessageEntity
 from pyrogram.errors import RPCError, UserIsBlocked, UserDeactivated
 from pyrogram.enums import ParseMode
 
 import anonyabbot
 
-from ...cache import CacheQueue
-from ...model import MemberRole, Message, Member, BanType, RedirectedMessage
+from ... import dbio
+from ...cache import JournalQueue
+from ...config import config
+from ...model import MemberRole, Message, Member, BanType
 from .. import pool
-from . import rosautils as _r
+from . import voice
 
 @dataclass(kw_only=True)
 class Operation:
@@ -28,6 +25,12 @@ class Operation:
     requests: int = 0
     errors: int = 0
     created: datetime = field(default_factory=datetime.now)
+    served: Set[int] = field(default_factory=set)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['finished'] = None
+        return state
 
 
 @dataclass(kw_only=True)
@@ -58,34 +61,27 @@ class UnpinOperation(Operation):
 @dataclass(kw_only=True)
 class BulkRedirectOperation(Operation):
     messages: List[Message]
+    advance: bool = True
     
 @dataclass(kw_only=True)
 class BulkPinOperation(Operation):
     messages: List[Message]
 
-class WorkerQueue(CacheQueue):
+class WorkerQueue(JournalQueue):
     __noproxy__ = ("_bot",)
     
     def __init__(self, path=None, bot=None):
         super().__init__(path)
         self._bot = bot
     
-    def save_hook(self, val):
-        results = []
-        for i in val:
-            ci = copy.copy(i)
-            ci.finished = None
-            results.append(ci)
-        return results
-    
     def load_hook(self, val):
-        for i in val:
-            if i.finished is None:
-                i.finished = asyncio.Event()
-            ic = getattr(i, 'context', None)
-            if ic:
-                if not hasattr(ic, '_client'):
-                    setattr(ic, '_client', self._bot)
+        if val.finished is None:
+            val.finished = asyncio.Event()
+        val.served = self.progress(val)
+        ic = getattr(val, 'context', None)
+        if ic:
+            if not hasattr(ic, '_client'):
+                setattr(ic, '_client', self._bot)
         return val
 
 class Worker:
@@ -100,13 +96,32 @@ class Worker:
             pool.worker_status['errors'] += errors
             pool.worker_status.save()
     
+    async def anonymized_voice(self: "anonyabbot.GroupBot", context: TM) -> Tuple[Union[str, BytesIO], int]:
+        """Get the file id of the voice anonymized before, or transform the voice for uploading."""
+        file_id = self.voice_cache.get(context.voice.file_unique_id, None)
+        if file_id:
+            return file_id, context.voice.duration
+        f_ogg = await self.bot.download_media(context, in_memory=True)
+        return await voice.service.transform(f_ogg.getvalue())
+
+    async def send_anonymized_voice(self: "anonyabbot.GroupBot", chat_id: int, context: TM, voice_file: Union[str, BytesIO], **kw):
+        if not isinstance(voice_file, str):
+            voice_file.seek(0)
+        masked_message = await self.bot.send_voice(chat_id, voice=voice_file, **kw)
+        if masked_message and not isinstance(voice_file, str):
+            self.voice_cache.set(context.voice.file_unique_id, masked_message.voice.file_id)
+        return masked_message
+
     async def bulk_redirector(self: "anonyabbot.GroupBot", op: BulkRedirectOperation):
+        cancelled = False
         try:
             if op.member.check_ban(BanType.RECEIVE, check_group=False, fail=False):
                 return
             if op.member.is_banned:
                 return
             for message in op.messages:
+                if message.id in op.served:
+                    continue
                 await asyncio.sleep(1)
                 if message.member.id == op.member.id:
                     continue
@@ -120,18 +135,35 @@ class Worker:
                     content = f"{message.mask} 发送了媒体."
                 
                 rmr = None
-                if message.reply_to:
-                    rmr = message.reply_to.get_redirect_for(op.member)
+                if message.reply_to_id:
+                    rmr = await dbio.io.read(lambda: message.reply_to.get_redirect_for(op.member))
 
                 try:
-                    if context.text:
+                    if context.voice and (self.group.is_prime or message.member.user.is_prime):
+                        voice_file, duration = await self.anonymized_voice(context)
+                        masked_message = await self.limiter.run(
+                            op.member.user.uid,
+                            self.send_anonymized_voice,
+                            op.member.user.uid,
+                            context,
+                            voice_file,
+                            duration=duration,
+                            caption=content,
+                            parse_mode=ParseMode.DISABLED,
+                            reply_to_message_id=rmr.mid if rmr else None,
+                        )
+                    elif context.text:
                         context.text = content
-                        masked_message = await context.copy(
+                        masked_message = await self.limiter.run(
+                            op.member.user.uid,
+                            context.copy,
                             op.member.user.uid,
                             reply_to_message_id=rmr.mid if rmr else None,
                         )
                     else:
-                        masked_message = await context.copy(
+                        masked_message = await self.limiter.run(
+                            op.member.user.uid,
+                            context.copy,
                             op.member.user.uid,
                             caption=content,
                             reply_to_message_id=rmr.mid if rmr else None,
@@ -139,21 +171,38 @@ class Worker:
                     if not masked_message:
                         op.errors += 1
                         continue
+                except (voice.VoiceBusy, asyncio.TimeoutError):
+                    # Voices which can not be anonymized in time are skipped, the rest of the batch goes on.
+                    self.log.debug(f"Voice of message {message.id} skipped in bulk redirect: voice service busy.")
+                    op.errors += 1
                 except RPCError as e:
                     if isinstance(e, (UserIsBlocked, UserDeactivated)) and not op.member.role == MemberRole.CREATOR:
                         op.member.role = MemberRole.LEFT
-                        op.member.save()
+                        await dbio.save(op.member)
+                        self.recipient_set.update(op.member)
                     op.errors += 1
                 else:
-                    RedirectedMessage(mid=masked_message.id, message=message, to_member=op.member).save()
+                    self.redirects.add(masked_message.id, message, op.member)
+                    op.served.add(message.id)
+                    self.delivered.append((op, message.id))
                 finally:
                     op.requests += 1
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
         except Exception as e:
             self.log.opt(exception=e).warning("Bulk redirector error:")
         finally:
+            await self.save_progress()
+            if op.advance and op.served:
+                await dbio.io.write(Member.advance, [op.member.id], max(op.served))
+            # Interrupted operations stay in the journal, and are resumed from their progress on restart.
+            if not cancelled:
+                self.queue.ack(op)
             op.finished.set()
             
     async def bulk_pinner(self: "anonyabbot.GroupBot", op: BulkPinOperation):
+        cancelled = False
         try:
             if op.member.check_ban(BanType.RECEIVE, check_group=False, fail=False):
                 return
@@ -162,27 +211,105 @@ class Worker:
             for message in op.messages:
                 try:
                     if op.member.id == message.member.id:
-                        await self.bot.pin_chat_message(
+                        await self.limiter.run(
+                            op.member.user.uid,
+                            self.bot.pin_chat_message,
                             op.member.user.uid, message.mid, both_sides=True, disable_notification=True
                         )
                     else:
-                        masked_message = message.get_redirect_for(op.member)
+                        masked_message = await dbio.io.read(message.get_redirect_for, op.member)
                         if masked_message:
-                            await self.bot.pin_chat_message(
+                            await self.limiter.run(
+                                op.member.user.uid,
+                                self.bot.pin_chat_message,
                                 op.member.user.uid, masked_message.mid, both_sides=True, disable_notification=True
                             )
                 except RPCError as e:
                     if isinstance(e, (UserIsBlocked, UserDeactivated)) and not op.member.role == MemberRole.CREATOR:
                         op.member.role = MemberRole.LEFT
-                        op.member.save()
+                        await dbio.save(op.member)
+                        self.recipient_set.update(op.member)
                     op.errors += 1
                 finally:
                     op.requests += 1
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
         except Exception as e:
             self.log.opt(exception=e).warning("Bulk pinner error:")
         finally:
+            if not cancelled:
+                self.queue.ack(op)
             op.finished.set()
     
+    def recipients(self: "anonyabbot.GroupBot", exclude: Member = None, check_receive=True):
+        return self.recipient_set.members(self.group, exclude=exclude, check_receive=check_receive)
+
+    async def fanout(
+        self: "anonyabbot.GroupBot",
+        op: Operation,
+        members: Iterable[Member],
+        send: Callable[[Member], Awaitable],
+    ):
+        """Run send for every member concurrently, bounded by the per-bot fanout limit and rate limiter."""
+
+        async def deliver(m: Member):
+            try:
+                # A fanout slot is taken before the rate limit token, so tokens are not spent by queued sends,
+                # and it is given back while the chat waits out a flood wait.
+                await self.limiter.run(m.user.uid, send, m, slot=self.fanout_limit)
+            except RPCError as e:
+                if isinstance(e, (UserIsBlocked, UserDeactivated)) and not m.role == MemberRole.CREATOR:
+                    m.role = MemberRole.LEFT
+                    # Recipients are cached members, only the role is written back.
+                    await dbio.io.write(m.save, only=[Member.role])
+                    self.recipient_set.update(m)
+                op.errors += 1
+            except Exception as e:
+                self.log.opt(exception=e).debug(f"Fanout to member {m.id} failed:")
+                op.errors += 1
+            else:
+                op.served.add(m.id)
+                self.delivered.append((op, m.id))
+            finally:
+                op.requests += 1
+
+        # Members served before a restart are checkpointed and skipped when the operation is resumed.
+        # Every delivery settles before the operation is finished, a failing recipient does not abort the others.
+        try:
+            await asyncio.gather(*[deliver(m) for m in members if m.id not in op.served], return_exceptions=True)
+        finally:
+            await self.save_progress()
+
+    async def save_progress(self: "anonyabbot.GroupBot"):
+        """Write buffered redirected messages, then checkpoint the deliveries they were sent for."""
+        # A delivery is only checkpointed once its redirected message is durable, otherwise a resumed
+        # operation would skip the member while replies to the message could not be resolved for it.
+        delivered, self.delivered = self.delivered, []
+        rows = self.redirects.take()
+        try:
+            await dbio.io.write_shard(self.redirects.flush, rows)
+        except Exception:
+            self.redirects.rows[:0] = rows
+            self.delivered[:0] = delivered
+            raise
+        progress = {}
+        for op, key in delivered:
+            progress.setdefault(id(op), (op, []))[1].append(key)
+        self.queue.checkpoint_many(progress.values())
+
+    async def redirect_flusher(self: "anonyabbot.GroupBot"):
+        """Flush buffered redirected messages periodically, so that replies to ongoing broadcasts can be resolved."""
+        try:
+            while True:
+                await asyncio.sleep(config.get('worker.flush_interval', 1))
+                try:
+                    await self.save_progress()
+                except Exception as e:
+                    self.log.opt(exception=e).warning("Redirect flusher error:")
+        finally:
+            await self.save_progress()
+
     async def worker(self: "anonyabbot.GroupBot"):
         while True:
             op = await self.queue.get()
@@ -192,6 +319,7 @@ class Worker:
             if isinstance(op, BulkPinOperation):
                 asyncio.create_task(self.bulk_pinner(op))
                 continue
+            cancelled = False
             try:
                 if not op:
                     break
@@ -214,28 +342,19 @@ class Worker:
                     
                     if op.context.voice:
                         if self.group.is_prime or op.member.user.is_prime:
-                            f_ogg = await self.bot.download_media(op.context, in_memory=True)
-                            f_ogg.seek(0)
-                            a_ogg = AudioSegment.from_ogg(f_ogg)
-                            f_wav = BytesIO()
-                            a_ogg.export(f_wav, format="wav")
-                            f_wav.seek(0)
-                            obj, sr = librosa.load(f_wav, sr=None)
-                            obj = _r.change_pitch(obj, sr, random.choice([-3, 3]))
-                            obj = _r.change_male(obj, sr, random.choice([600, 900]))
-                            f_wav_mod = BytesIO()
-                            sf.write(f_wav_mod, obj, sr, format='wav')
-                            f_wav_mod.seek(0)
-                            a_wav = AudioSegment.from_wav(f_wav_mod)
-                            duration = int(a_wav.duration_seconds)
-                            f_ogg_mod = BytesIO()
-                            a_wav.export(f_ogg_mod, format="ogg")
-                            f_ogg_mod.seek(0)
-                            f_ogg_mod.name = 'tmp.ogg'
-                            voice_file_id = None
+                            try:
+                                voice_file, duration = await self.anonymized_voice(op.context)
+                            except (voice.VoiceBusy, asyncio.TimeoutError):
+                                await self.info(
+                                    "⚠️ 语音处理繁忙, 该语音消息未能发送, 请稍后重试.",
+                                    context=op.context,
+                                    block=False,
+                                )
+                                continue
                         else:
-                            voice_file_id = op.context.voice.file_id
+                            voice_file = op.context.voice.file_id
                             duration = None
+                        voice_lock = asyncio.Lock()
 
                     if op.context.text:   
                         op.context.text = content
@@ -250,56 +369,49 @@ class Worker:
                             for e in op.context.caption_entities:
                                 e.offset += offset
 
-                    m: Member
-                    for m in self.group.user_members():
-                        if m.id == op.member.id:
-                            continue
-                        if m.is_banned:
-                            continue
-                        if m.check_ban(BanType.RECEIVE, check_group=False, fail=False):
-                            continue
-
-                        rmr = None
-                        if op.message.reply_to:
-                            rmr = op.message.reply_to.get_redirect_for(m)
-
-                        try:
-                            if op.context.text:
-                                masked_message = await op.context.copy(
-                                    m.user.uid,
-                                    reply_to_message_id = rmr.mid if rmr else None,
-                                )
-                            else:
-                                if op.context.voice:
-                                    masked_message = await self.bot.send_voice(
-                                        m.user.uid,
-                                        voice = f_ogg_mod if not voice_file_id else voice_file_id,
-                                        duration = duration,
-                                        caption = op.context.caption,
-                                        parse_mode = ParseMode.DISABLED,
-                                        caption_entities = op.context.caption_entities,
-                                        reply_to_message_id = rmr.mid if rmr else None,
-                                        reply_markup = op.context.reply_markup,
-                                    )
-                                    if not voice_file_id:
-                                        voice_file_id = masked_message.voice.file_id
-                                else:
-                                    masked_message = await op.context.copy(
-                                        m.user.uid,
-                                        reply_to_message_id = rmr.mid if rmr else None,
-                                    )
-                            if not masked_message:
-                                op.errors += 1
-                                continue
-                        except RPCError as e:
-                            if isinstance(e, (UserIsBlocked, UserDeactivated)) and not m.role == MemberRole.CREATOR:
-                                m.role = MemberRole.LEFT
-                                m.save()
-                            op.errors += 1
+                    async def send_voice(m: Member, reply_to_message_id: int = None):
+                        nonlocal voice_file
+                        params = dict(
+                            duration = duration,
+                            caption = op.context.caption,
+                            parse_mode = ParseMode.DISABLED,
+                            caption_entities = op.context.caption_entities,
+                            reply_to_message_id = reply_to_message_id,
+                            reply_markup = op.context.reply_markup,
+                        )
+                        # The transformed voice is uploaded only once, later recipients reuse its file id.
+                        async with voice_lock:
+                            if not isinstance(voice_file, str):
+                                masked_message = await self.send_anonymized_voice(m.user.uid, op.context, voice_file, **params)
+                                if masked_message:
+                                    voice_file = masked_message.voice.file_id
+                                return masked_message
+                        return await self.bot.send_voice(m.user.uid, voice=voice_file, **params)
+
+                    members = list(self.recipients(exclude=op.member))
+                    replied = {}
+                    if op.message.reply_to_id:
+                        replied = await dbio.io.read(lambda: op.message.reply_to.get_redirects_for(members))
+
+                    async def send(m: Member):
+                        rmr = replied.get(m.id, None)
+
+                        if op.context.voice and not op.context.text:
+                            masked_message = await send_voice(m, reply_to_message_id=rmr.mid if rmr else None)
                         else:
-                            RedirectedMessage(mid=masked_message.id, message=op.message, to_member=m).save()
-                        finally:
-                            op.requests += 1
+                            masked_message = await op.context.copy(
+                                m.user.uid,
+                                reply_to_message_id = rmr.mid if rmr else None,
+                            )
+                        if not masked_message:
+                            op.errors += 1
+                            return
+                        self.redirects.add(masked_message.id, op.message, m)
+
+                    try:
+                        await self.fanout(op, members, send)
+                    finally:
+                        await dbio.io.write(Member.advance, [op.member.id, *op.served], op.message.id)
 
                 elif isinstance(op, EditOperation):
                     if self.group.cannot(BanType.RECEIVE):
@@ -313,110 +425,71 @@ class Worker:
                     else:
                         content = f"{op.message.mask} 发送了媒体."
 
-                    m: Member
-                    for m in self.group.user_members():
-                        if m.id == op.member.id:
-                            continue
-                        if m.is_banned:
-                            continue
-                        if m.check_ban(BanType.RECEIVE, check_group=False, fail=False):
-                            continue
-
-                        try:
-                            masked_message = op.message.get_redirect_for(m)
-                            if masked_message:
-                                await self.bot.edit_message_text(masked_message.to_member.user.uid, masked_message.mid, content)
-                        except RPCError as e:
-                            if isinstance(e, (UserIsBlocked, UserDeactivated)) and not m.role == MemberRole.CREATOR:
-                                m.role = MemberRole.LEFT
-                                m.save()
-                            op.errors += 1
-                        finally:
-                            op.requests += 1
+                    members = list(self.recipients(exclude=op.member))
+                    copies = await dbio.get_redirects_for(op.message, members)
+                    # Only members with a copy are sent a request, so no rate limit token is taken for the others.
+                    members = [m for m in members if m.id in copies]
+
+                    async def send(m: Member):
+                        masked_message = copies[m.id]
+                        await self.bot.edit_message_text(m.user.uid, masked_message.mid, content)
+
+                    await self.fanout(op, members, send)
 
                 elif isinstance(op, DeleteOperation):
                     if self.group.cannot(BanType.RECEIVE):
                         op.finished.set()
                         continue
 
-                    m: Member
-                    for m in self.group.user_members():
-                        if m.is_banned:
-                            continue
-                        if m.check_ban(BanType.RECEIVE, check_group=False, fail=False):
-                            continue
-
-                        try:
-                            if m.id == op.message.member.id:
-                                await self.bot.delete_messages(op.message.member.user.uid, op.message.mid)
-                            else:
-                                masked_message = op.message.get_redirect_for(m)
-                                if masked_message:
-                                    await self.bot.delete_messages(masked_message.to_member.user.uid, masked_message.mid)
-                        except RPCError as e:
-                            if isinstance(e, (UserIsBlocked, UserDeactivated)) and not m.role == MemberRole.CREATOR:
-                                m.role = MemberRole.LEFT
-                                m.save()
-                            op.errors += 1
-                        finally:
-                            op.requests += 1
+                    members = list(self.recipients())
+                    # The copy of the sender is the message itself.
+                    copies = await dbio.get_redirects_for(op.message, members)
+                    members = [m for m in members if m.id in copies]
+
+                    async def send(m: Member):
+                        masked_message = copies[m.id]
+                        await self.bot.delete_messages(m.user.uid, masked_message.mid)
+
+                    await self.fanout(op, members, send)
 
                 elif isinstance(op, PinOperation):
                     if self.group.cannot(BanType.RECEIVE):
                         op.finished.set()
                         continue
 
-                    m: Member
-                    for m in self.group.user_members():
-                        if m.is_banned:
-                            continue
-                        
-                        try:
-                            if m.id == op.message.member.id:
-                                await self.bot.pin_chat_message(
-                                    op.message.member.user.uid, op.message.mid, both_sides=True, disable_notification=True
-                                )
-                            else:
-                                masked_message = op.message.get_redirect_for(m)
-                                if masked_message:
-                                    await self.bot.pin_chat_message(
-                                        masked_message.to_member.user.uid, masked_message.mid, both_sides=True, disable_notification=True
-                                    )
-                        except RPCError as e:
-                            if isinstance(e, (UserIsBlocked, UserDeactivated)) and not m.role == MemberRole.CREATOR:
-                                m.role = MemberRole.LEFT
-                                m.save()
-                            op.errors += 1
-                        finally:
-                            op.requests += 1
+                    members = list(self.recipients(check_receive=False))
+                    copies = await dbio.get_redirects_for(op.message, members)
+                    members = [m for m in members if m.id in copies]
+
+                    async def send(m: Member):
+                        masked_message = copies[m.id]
+                        await self.bot.pin_chat_message(m.user.uid, masked_message.mid, both_sides=True, disable_notification=True)
+
+                    await self.fanout(op, members, send)
 
                 elif isinstance(op, UnpinOperation):
                     if self.group.cannot(BanType.RECEIVE):
                         op.finished.set()
                         continue
 
-                    m: Member
-                    for m in self.group.user_members():
-                        if m.is_banned:
-                            continue
+                    members = list(self.recipients(check_receive=False))
+                    copies = await dbio.get_redirects_for(op.message, members)
+                    members = [m for m in members if m.id in copies]
 
-                        try:
-                            if m.id == op.message.member.id:
-                                await self.bot.unpin_chat_message(op.message.member.user.uid, op.message.mid)
-                            else:
-                                masked_message = op.message.get_redirect_for(m)
-                                if masked_message:
-                                    await self.bot.unpin_chat_message(masked_message.to_member.user.uid, masked_message.mid)
-                        except RPCError as e:
-                            if isinstance(e, (UserIsBlocked, UserDeactivated)) and not m.role == MemberRole.CREATOR:
-                                m.role = MemberRole.LEFT
-                                m.save()
-                            op.errors += 1
-                        finally:
-                            op.requests += 1
+                    async def send(m: Member):
+                        masked_message = copies[m.id]
+                        await self.bot.unpin_chat_message(m.user.uid, masked_message.mid)
+
+                    await self.fanout(op, members, send)
                 waiting_time = (datetime.now() - op.created).total_seconds() 
                 await self.report_status(waiting_time, op.requests, op.errors)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
             except Exception as e:
                 self.log.opt(exception=e).warning("Worker error:")
             finally:
-                op.finished.set()
\ No newline at end of file
+                # Operations interrupted by shutdown are kept in the journal to be replayed.
+                if not cancelled:
+                    self.queue.ack(op)
+                op.finished.set()
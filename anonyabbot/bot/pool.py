@@ -3,9 +3,12 @@ from datetime import datetime
 
 from loguru import logger
 
+from .. import dbio, retention
 from ..utils import AsyncTaskPool
 from ..cache import CacheDict
-from ..model import Group, User
+from ..config import config
+from ..model import Group, User, group_activity, member_activity, reconcile_counters
+from .fix import user_records
 from .group import GroupBot
 
 pool = AsyncTaskPool()
@@ -74,7 +77,60 @@ async def start_groups():
     logger.info("All groupbots are started.")
 
 
+async def user_flusher():
+    """Write changed user profiles in batches."""
+    try:
+        while True:
+            await asyncio.sleep(config.get('database.user_flush_interval', 10))
+            try:
+                await dbio.io.write(user_records.flush, user_records.take())
+            except Exception as e:
+                logger.opt(exception=e).warning("User flusher error:")
+    finally:
+        user_records.flush()
+
+
+async def activity_flusher():
+    """Write last activity times of groups and members in batches."""
+    try:
+        while True:
+            await asyncio.sleep(config.get('database.activity_flush_interval', 60))
+            try:
+                await dbio.io.write(group_activity.flush, group_activity.take())
+                await dbio.io.write(member_activity.flush, member_activity.take())
+            except Exception as e:
+                logger.opt(exception=e).warning("Activity flusher error:")
+    finally:
+        group_activity.flush()
+        member_activity.flush()
+
+
+async def counter_reconciler():
+    """Recount member and message counters periodically, repairing any drift."""
+    while True:
+        await asyncio.sleep(config.get('database.reconcile_interval', 86400))
+        try:
+            for g in Group.select(Group.id):
+                await dbio.io.write(reconcile_counters, g)
+        except Exception as e:
+            logger.opt(exception=e).warning("Counter reconciler error:")
+
+
+async def retention_pruner():
+    """Delete messages older than the retention window of their groups periodically."""
+    while True:
+        await asyncio.sleep(config.get('database.retention_interval', 3600))
+        try:
+            await retention.prune()
+        except Exception as e:
+            logger.opt(exception=e).warning("Retention pruner error:")
+
+
 async def start():
     pool.add(queue_monitor())
+    pool.add(counter_reconciler())
+    pool.add(retention_pruner())
+    pool.add(user_flusher())
+    pool.add(activity_flusher())
     pool.add(start_groups())
     await pool.wait()
@@ -0,0 +1,131 @@
+import asyncio
+from contextlib import nullcontext
+from contextvars import ContextVar
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+from pyrogram.errors import FloodWait
+
+# Set while a call runs under a rate limiter, so that the client raises FloodWait instead of sleeping.
+limited: ContextVar[bool] = ContextVar("limited", default=False)
+
+
+class TokenBucket:
+    """A token bucket refilled at a fixed rate, which can be blocked for a period of time."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds to wait until a token is available."""
+        self.refill()
+        wait = max(0, self.blocked_until - time.monotonic())
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self):
+        self.refill()
+        return self.tokens >= self.burst and self.blocked_until <= time.monotonic()
+
+
+class RateLimiter:
+    """
+    A global per-bot token bucket plus per-chat buckets for outgoing requests.
+    Note:
+        FloodWait shrinks the global rate and blocks only the affected chat,
+        the rate then recovers slowly on successful requests.
+    """
+
+    def __init__(self, rate: float = 25, chat_rate: float = 1, chat_burst: float = 3, min_rate: float = 1, retries: int = 3):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.bucket = TokenBucket(rate)
+        self.chats: Dict[int, TokenBucket] = {}
+        self.waiting = 0
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    @property
+    def backlog(self):
+        return self.waiting
+
+    def chat(self, chat_id: int):
+        bucket = self.chats.get(chat_id, None)
+        if not bucket:
+            if len(self.chats) > 10000:
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle}
+            self.chats[chat_id] = bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id: Optional[int]):
+        """Wait for a token of the bot and of the chat, requests without a chat only take a token of the bot."""
+        chat = self.chat(chat_id) if chat_id is not None else None
+        self.waiting += 1
+        try:
+            while True:
+                wait = max(self.bucket.delay(), chat.delay() if chat else 0)
+                if wait <= 0:
+                    self.bucket.take()
+                    if chat:
+                        chat.take()
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+
+    def penalize(self, chat_id: int, seconds: float):
+        self.chat(chat_id).block(seconds)
+        self.bucket.rate = max(self.min_rate, self.bucket.rate * 0.5)
+        logger.debug(f"Flood wait of {seconds}s for chat {chat_id}, rate limit is lowered to {self.bucket.rate:.1f}/s.")
+
+    def reward(self):
+        if self.bucket.rate < self.max_rate:
+            self.bucket.refill()
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + 0.1)
+
+    async def run(self, chat_id: int, func: Callable[..., Awaitable], *args, slot: asyncio.Semaphore = None, **kw):
+        """
+        Call func once a token for the chat is available, retrying it after flood waits.
+        Note:
+            Each attempt holds slot if given, which is released while waiting for a flood wait of the chat to pass.
+        """
+        token = limited.set(True)
+        try:
+            for i in range(self.retries + 1):
+                async with slot or nullcontext():
+                    await self.acquire(chat_id)
+                    try:
+                        result = await func(*args, **kw)
+                    except FloodWait as e:
+                        if i >= self.retries:
+                            raise
+                        self.penalize(chat_id, e.value)
+                    else:
+                        self.reward()
+                        return result
+                await asyncio.sleep(self.chat(chat_id).delay())
+        finally:
+            limited.reset(token)
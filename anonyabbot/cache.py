@@ -1,5 +1,7 @@
 import asyncio
 from collections import deque
+import time
+from typing import Any, Iterable, Tuple
 
 import dill
 from loguru import logger
@@ -66,11 +68,12 @@ class Cache:
             else:
                 return default
                 
+        val = pval
         if isinstance(pval, bytes):
             try:
                 val = dill.loads(pval)
             except dill.UnpicklingError:
-                pass
+                val = pval.decode()
         return val
         
     def set(self, key=None, val=Def, ttl=None):
@@ -86,6 +89,39 @@ class Cache:
             ttl = self.source.ttl(self.get_path(key))
         self.source.set(self.get_path(key), pval, ex=ttl)
     
+class BoundedCache(Cache):
+    """A cache keeping at most size keys under its base, the least recently used ones are evicted first."""
+    
+    def __init__(self, base=None, size=1000, ttl=None):
+        super().__init__(base)
+        self._size = size
+        self._ttl = ttl
+    
+    @property
+    def _index(self):
+        return f'{self._base}.__index__'
+    
+    def get(self, key=None, default=Def):
+        try:
+            val = super().get(key)
+        except KeyError:
+            if default is Def:
+                raise
+            return default
+        self.source.zadd(self._index, {key: time.time()})
+        return val
+    
+    def set(self, key=None, val=Def, ttl=None):
+        super().set(key, val, ttl=ttl or self._ttl)
+        now = time.time()
+        self.source.zadd(self._index, {key: now})
+        if self._ttl:
+            self.source.zremrangebyscore(self._index, 0, now - self._ttl)
+        excess = self.source.zcard(self._index) - self._size
+        if excess > 0:
+            for k, _ in self.source.zpopmin(self._index, excess):
+                self.source.delete(self.get_path(k.decode()))
+    
 class CacheDict(ProxyBase):
     __noproxy__ = ("_cache", "_path", "_default")
     
@@ -146,4 +182,110 @@ class CacheQueue(ProxyBase):
         return await self._cache.put(item)
     
     def save_hook(self, val):
-        return val
\ No newline at end of file
+        return val
+    
+    def ack(self, item):
+        pass
+
+class JournalQueue(ProxyBase):
+    """
+    A persistent queue which journals each item separately in a redis hash.
+    Note:
+        Items stay in the journal until acknowledged, and unacknowledged items are replayed on reload.
+    """
+    
+    __noproxy__ = ("_cache", "_path", "_ids")
+    
+    def __init__(self, path=None):
+        self._cache = None
+        self._path = path
+        self._ids = {}
+    
+    @property
+    def __subject__(self):
+        self.reload(force=False)
+        return self._cache
+    
+    @property
+    def _source(self):
+        if not Cache.source:
+            Cache.refresh()
+        return Cache.source
+    
+    @property
+    def _journal(self):
+        return f'{self._path}.journal'
+    
+    def reload(self, force=True):
+        if self._cache is None or force:
+            self._cache = asyncio.Queue()
+            self._ids = {}
+            self.migrate()
+            journal = self._source.hgetall(self._journal)
+            for jid in sorted(journal, key=int):
+                item = dill.loads(journal[jid])
+                self._ids[id(item)] = int(jid)
+                item = self.load_hook(item)
+                self._ids[id(item)] = int(jid)
+                self._cache.put_nowait(item)
+    
+    def migrate(self):
+        """Move items saved by CacheQueue into the journal."""
+        try:
+            legacy = Cache(self._path).get()
+        except KeyError:
+            return
+        if isinstance(legacy, list):
+            for item in legacy:
+                self._append(item)
+        self._source.delete(self._path)
+    
+    def _append(self, item):
+        jid = self._source.incr(f'{self._path}.seq')
+        self._source.hset(self._journal, jid, dill.dumps(self.save_hook(item)))
+        self._ids[id(item)] = jid
+        return jid
+    
+    def load_hook(self, val):
+        return val
+    
+    def save_hook(self, val):
+        return val
+    
+    async def get(self):
+        self.reload(force=False)
+        return await self._cache.get()
+    
+    async def put(self, item):
+        self.reload(force=False)
+        self._append(item)
+        return await self._cache.put(item)
+    
+    def ack(self, item):
+        """Remove a processed item and its progress from the journal."""
+        jid = self._ids.pop(id(item), None)
+        if jid is not None:
+            self._source.hdel(self._journal, jid)
+            self._source.delete(f'{self._path}.progress.{jid}')
+    
+    def checkpoint(self, item, *keys: int):
+        """Record that parts of the item, identified by keys, have been processed."""
+        self.checkpoint_many([(item, keys)])
+    
+    def checkpoint_many(self, progress: Iterable[Tuple[Any, Iterable[int]]]):
+        """Record processed keys of several items, as (item, keys) pairs, with one SADD per item in a single round trip."""
+        pipe = self._source.pipeline(transaction=False)
+        for item, keys in progress:
+            jid = self._ids.get(id(item), None)
+            keys = list(keys)
+            if jid is not None and keys:
+                pipe.sadd(f'{self._path}.progress.{jid}', *keys)
+        if len(pipe):
+            pipe.execute()
+    
+    def progress(self, item):
+        """Get keys checkpointed for the item."""
+        jid = self._ids.get(id(item), None)
+        if jid is None:
+            return set()
+        return {int(k) for k in self._source.smembers(f'{self._path}.progress.{jid}')}
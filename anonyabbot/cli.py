@@ -19,7 +19,9 @@ patch_pyrogram()
 
 from .bot.pool import start as start_pool
 from .bot.father import FatherBot
-from .model import BaseModel, db
+from . import dbio
+from .model import BaseModel, PackedRedirect, db, shards
+from .migrate import enable_incremental_vacuum, move_to_shards, stamp, upgrade, upgrade_shards
 
 
 def formatter(record):
@@ -60,16 +62,52 @@ def main(
         dir_okay=False,
         allow_dash=True,
         help="Config toml file",
-    )
+    ),
+    dry_run: bool = typer.Option(False, "--dry-run", help="Show pending database migrations without applying them"),
+    vacuum: bool = typer.Option(
+        False, "--vacuum", help="Enable incremental vacuum on an existing database, which rewrites the whole file once"
+    ),
 ):
     config.reload_conf(config_file)
     basedir = Path(config.get("basedir", user_data_dir(__product__)))
     logger.debug(f'Now using basedir at "{basedir.absolute()}"')
     basedir.mkdir(parents=True, exist_ok=True)
-    db.init(str(basedir / f"{__product__}.db"), pragmas={"journal_mode": "wal"})
-    db.create_tables(BaseModel.__subclasses__())
+    pragmas = {
+        "auto_vacuum": "incremental",
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "memory",
+        "wal_autocheckpoint": 0,
+    }
+    pragmas.update(config.get("database.pragmas", {}))
+    db.init(str(basedir / f"{__product__}.db"), pragmas=pragmas)
+    PackedRedirect.enabled = config.get("database.redirect_storage", "rows") == "packed"
+    fresh = not db.get_tables()
+    if dry_run:
+        if fresh:
+            logger.info("Database is empty, tables will be created with the current schema.")
+        else:
+            asyncio.run(upgrade(dry_run=True))
+            if vacuum:
+                enable_incremental_vacuum(dry_run=True)
+        return
+    dbio.checkpointer.start()
+    if fresh:
+        # Existing databases are brought to the current schema by the migrations in upgrade().
+        db.create_tables(BaseModel.__subclasses__())
+        stamp()
 
     async def async_main():
+        await upgrade()
+        if vacuum and enable_incremental_vacuum():
+            logger.info("Database is converted to incremental vacuum.")
+        if config.get("database.shards", False):
+            shards.init(basedir / "shards", pragmas=pragmas, size=config.get("database.shard_files", 64))
+            await move_to_shards()
+            shards.enabled = True
+            await upgrade_shards()
         await asyncio.gather(FatherBot(config["father.token"]).start(), start_pool())
 
     asyncio.run(async_main())
@@ -0,0 +1,204 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import partial
+import os
+from threading import Event, Thread
+import time
+from typing import Callable, Dict, Iterable, TypeVar
+
+from loguru import logger
+from peewee import ModelSelect, SqliteDatabase
+from pyrogram.types import User as TU
+
+from .config import config
+from .model import Group, Member, MemberRole, Message, PMMessage, RedirectedMessage, ReplyIndex, User, UserRole, db, shards
+
+T = TypeVar("T")
+
+
+class DatabaseIO:
+    """
+    Run database calls in threads, so that slow queries do not block the event loop.
+    Note:
+        Writes are serialized on a single thread per database file, while reads run concurrently on a thread pool.
+        Each thread uses its own sqlite connection, and WAL mode lets readers run alongside the writer.
+        Writes to the main database go through write(), writes to the message tables of the current group go through
+        write_shard(), which runs them on one of database.shard_writers threads when per-group shards are enabled,
+        so that groups in different files are written in parallel while each file still has a single writer.
+    """
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.shard_writers = []
+
+    def start(self):
+        if not self.writer:
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+            self.reader = ThreadPoolExecutor(max_workers=config.get("database.readers", 4), thread_name_prefix="db-read")
+
+    def stop(self):
+        for executor in (self.reader, self.writer, *self.shard_writers):
+            if executor:
+                executor.shutdown(wait=True)
+        self.reader = self.writer = None
+        self.shard_writers = []
+
+    def writer_for(self, group_id: int = None) -> ThreadPoolExecutor:
+        if group_id is None or not shards.enabled:
+            return self.writer
+        if not self.shard_writers:
+            self.shard_writers = [
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-write-{i}")
+                for i in range(config.get("database.shard_writers", 4))
+            ]
+        return self.shard_writers[group_id % len(self.shard_writers)]
+
+    async def run(self, executor: ThreadPoolExecutor, func: Callable[..., T], *args, **kw) -> T:
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(executor, context.run, leased, partial(func, *args, **kw))
+
+    async def read(self, func: Callable[..., T], *args, **kw) -> T:
+        self.start()
+        return await self.run(self.reader, func, *args, **kw)
+
+    async def write(self, func: Callable[..., T], *args, **kw) -> T:
+        self.start()
+        return await self.run(self.writer, func, *args, **kw)
+
+    async def write_shard(self, func: Callable[..., T], *args, **kw) -> T:
+        self.start()
+        return await self.run(self.writer_for(shards.current()), func, *args, **kw)
+
+
+def leased(func: Callable[[], T]) -> T:
+    """Call func holding a lease on the file of the current group, if shards are enabled."""
+    group_id = shards.current()
+    if group_id is None or not shards.enabled:
+        return func()
+    with shards.lease(group_id):
+        return func()
+
+
+io = DatabaseIO()
+
+
+class Checkpointer(Thread):
+    """
+    Checkpoint the write-ahead logs of the main and shard databases in a background thread.
+    Note:
+        Automatic checkpoints should be disabled (wal_autocheckpoint = 0), so that they do not run inside whichever commit
+        crosses the limit. A passive checkpoint runs every database.checkpoint_interval seconds, and a truncating checkpoint
+        runs once a log grows past database.checkpoint_wal_size bytes and a passive checkpoint has copied all of it, so
+        that writers are not blocked while readers or a long transaction hold the log.
+    """
+
+    def __init__(self):
+        super().__init__(name="db-checkpoint", daemon=True)
+        self.stopped = Event()
+        self.status = {"wal_size": 0, "checkpoints": 0, "time": 0.0, "max_time": 0.0}
+
+    def databases(self):
+        return [db, *list(shards.databases.values())]
+
+    def wal_size(self, database: SqliteDatabase) -> int:
+        try:
+            return os.path.getsize(f"{database.database}-wal")
+        except OSError:
+            return 0
+
+    def checkpoint(self, database: SqliteDatabase, mode: str = "PASSIVE") -> bool:
+        """Run a checkpoint, returns whether all frames in the log are copied to the database."""
+        database.connect(reuse_if_open=True)
+        start = time.perf_counter()
+        busy, log, done = database.execute_sql(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        spent = time.perf_counter() - start
+        self.status["checkpoints"] += 1
+        self.status["time"] += spent
+        self.status["max_time"] = max(self.status["max_time"], spent)
+        return not busy and log == done
+
+    def run(self):
+        last = time.monotonic()
+        while not self.stopped.wait(config.get("database.checkpoint_poll", 1)):
+            scheduled = time.monotonic() - last >= config.get("database.checkpoint_interval", 60)
+            limit = config.get("database.checkpoint_wal_size", 64 * 1024 * 1024)
+            total = 0
+            for database in self.databases():
+                if getattr(database, "retired", False):
+                    continue
+                try:
+                    size = self.wal_size(database)
+                    if size > limit:
+                        start = time.perf_counter()
+                        if self.checkpoint(database, "PASSIVE") and self.checkpoint(database, "TRUNCATE"):
+                            spent = (time.perf_counter() - start) * 1000
+                            logger.debug(f"Truncated {size / 1024 / 1024:.1f} MB log of {database.database} in {spent:.0f} ms.")
+                    elif scheduled and size:
+                        self.checkpoint(database, "PASSIVE")
+                    total += self.wal_size(database)
+                except Exception as e:
+                    logger.opt(exception=e).warning("Checkpoint error:")
+            self.status["wal_size"] = total
+            if scheduled:
+                last = time.monotonic()
+
+    def stop(self):
+        self.stopped.set()
+
+
+checkpointer = Checkpointer()
+
+
+async def get_record(user: TU) -> User:
+    """Get the record of a user, which is read on the reader pool and only created on the writer."""
+    ur = await io.read(user.get_record, create=False)
+    if not ur:
+        ur = await io.write(user.get_record)
+    # Profile changes are tracked on the event loop, and written by the user flusher.
+    user.sync_record(ur)
+    return ur
+
+
+async def get_member(user: TU, group: Group) -> Member:
+    ur = await get_record(user)
+    return await io.read(ur.member_in, group)
+
+
+async def validate(record: "User | Member", role: "UserRole | MemberRole", fail=False, reversed=False) -> bool:
+    return await io.read(record.validate, role, fail=fail, reversed=reversed)
+
+
+async def save(record):
+    return await io.write(record.save)
+
+
+async def get_or_none(model, *query, **filters):
+    return await io.read(model.get_or_none, *query, **filters)
+
+
+async def get_redirects_for(message: Message, members: Iterable[Member]) -> "Dict[int, Message | RedirectedMessage]":
+    return await io.read(message.get_redirects_for, members)
+
+
+async def resolve_reply(member: Member, mid: int) -> "Message | PMMessage | None":
+    return await io.read(ReplyIndex.resolve, member, mid)
+
+
+async def create_message(**kw) -> Message:
+    message = await io.write_shard(Message.create, **kw)
+    await io.write(message.add_to_counters)
+    return message
+
+
+async def create_pm_message(**kw) -> PMMessage:
+    return await io.write_shard(PMMessage.create, **kw)
+
+
+async def count(query: ModelSelect) -> int:
+    return await io.read(query.count)
+
+
+async def n_members(group: Group) -> int:
+    return await io.read(lambda: group.n_members)
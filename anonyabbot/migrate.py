@@ -0,0 +1,353 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, List, Type
+
+from loguru import logger
+from peewee import CharField, DateTimeField, Field, IntegerField, Model, ModelSelect, SqliteDatabase, chunked, fn
+from playhouse.migrate import SqliteMigrator, migrate as run_operations
+
+from .model import (
+    BanGroup,
+    BanGroupEntry,
+    DROPPED_INDEXES,
+    DROPPED_TABLES,
+    BaseModel,
+    Group,
+    Member,
+    Message,
+    PackedRedirect,
+    PMMessage,
+    RedirectedMessage,
+    ReplyEntry,
+    SHARD_VERSION,
+    db,
+    reconcile_counters,
+    shards,
+)
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied = DateTimeField(default=datetime.now)
+
+
+class Migrator:
+    """Schema helpers passed to migrations, which only log what would be done in dry-run mode."""
+
+    def __init__(self, dry_run=False, database: SqliteDatabase = db):
+        self.dry_run = dry_run
+        self.database = database
+        self.schema = SqliteMigrator(database)
+
+    def apply(self, *operations):
+        """Run operations created by self.schema, such as self.schema.rename_column(...)."""
+        for op in operations:
+            if self.dry_run:
+                logger.info(f"Would run {op.method} {op.args}.")
+            else:
+                run_operations(op)
+
+    def execute(self, sql: str, params=None):
+        if self.dry_run:
+            logger.info(f"Would execute: {sql}")
+        else:
+            self.database.execute_sql(sql, params)
+
+    def add_column(self, model: Type[Model], name: str):
+        """Add a column declared on the model, if it does not exist yet."""
+        field: Field = model._meta.fields[name]
+        table = model._meta.table_name
+        if field.column_name in {c.name for c in self.database.get_columns(table)}:
+            return
+        if self.dry_run:
+            logger.info(f"Would add column {table}.{field.column_name}.")
+        else:
+            run_operations(self.schema.add_column(table, field.column_name, field))
+
+    def drop_indexes(self, names):
+        """Drop indexes by name, if they exist."""
+        existing = {r[0] for r in self.database.execute_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for name in names:
+            if name in existing:
+                self.execute(f'DROP INDEX "{name}"')
+
+    def add_indexes(self, model: Type[Model]):
+        """Create indexes declared on the model, if they do not exist yet."""
+        if self.dry_run:
+            existing = {i.name for i in self.database.get_indexes(model._meta.table_name)}
+            for index in model._meta.fields_to_index():
+                if index._name not in existing:
+                    logger.info(f"Would create index {index._name} on {model._meta.table_name}.")
+        else:
+            model._schema.create_indexes(safe=True)
+
+    async def backfill(self, query: ModelSelect, update: Callable[[List[Model]], None], batch: int = 1000):
+        """Call update on rows of the query in batches of primary key order, yielding to the event loop in between."""
+        model = query.model
+        pk = model._meta.primary_key
+        last = None
+        count = 0
+        while True:
+            q = query.order_by(pk).limit(batch)
+            if last is not None:
+                q = q.where(pk > last)
+            rows = list(q)
+            if not rows:
+                break
+            if not self.dry_run:
+                with self.database.atomic():
+                    update(rows)
+            count += len(rows)
+            last = getattr(rows[-1], pk.name)
+            await asyncio.sleep(0)
+        if self.dry_run:
+            logger.info(f"Would backfill {count} rows of {model._meta.table_name}.")
+        return count
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    func: Callable[[Migrator], Awaitable]
+
+
+migrations: List[Migration] = []
+
+
+def migration(version: int):
+    """Register an async migration function, which is applied once in version order."""
+
+    def decorator(func):
+        migrations.append(Migration(version=version, name=func.__name__, func=func))
+        migrations.sort(key=lambda m: m.version)
+        return func
+
+    return decorator
+
+
+def current_version() -> int:
+    if not SchemaVersion.table_exists():
+        return 0
+    return SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+
+
+def pending():
+    version = current_version()
+    return [m for m in migrations if m.version > version]
+
+
+def stamp():
+    """Mark all migrations as applied, used for databases created with the current schema."""
+    SchemaVersion.create_table(safe=True)
+    with db.atomic():
+        for m in pending():
+            SchemaVersion.create(version=m.version, name=m.name)
+
+
+async def upgrade(dry_run=False):
+    """Apply pending migrations in order, returns the number of migrations applied."""
+    todo = pending()
+    if not todo:
+        return 0
+    migrator = Migrator(dry_run=dry_run)
+    if not dry_run:
+        SchemaVersion.create_table(safe=True)
+    for m in todo:
+        logger.info(f"{'Checking' if dry_run else 'Applying'} database migration {m.version}: {m.name}.")
+        await m.func(migrator)
+        if not dry_run:
+            SchemaVersion.create(version=m.version, name=m.name)
+    if not dry_run:
+        db.execute_sql("PRAGMA optimize")
+    return len(todo)
+
+
+def enable_incremental_vacuum(dry_run=False) -> bool:
+    """Convert the main database to incremental auto-vacuum with a full VACUUM, returns whether it was needed."""
+    if db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    m = Migrator(dry_run=dry_run)
+    m.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    m.execute("VACUUM")
+    return True
+
+
+def move_rows(database: SqliteDatabase, tables: list, batch: int = 100):
+    """Copy rows of (model, condition) pairs from the main database into a shard file, then delete them from the main database."""
+    with database.atomic(), db.atomic():
+        for model, condition in tables:
+            for rows in chunked(list(model.select().where(condition).dicts()), batch):
+                model.insert_many(rows).execute(database)
+            model.delete().where(condition).execute()
+
+
+async def move_to_shards(batch: int = 500):
+    """Move message tables of each group from the main database into its shard file, used before shards are enabled."""
+    moved = 0
+    for g in Group.select(Group.id):
+        database = None
+        while True:
+            ids = [m.id for m in Message.select(Message.id).where(Message.group == g.id).order_by(Message.id).limit(batch)]
+            pms = [
+                p.id
+                for p in PMMessage.select(PMMessage.id)
+                .join(Member, on=(PMMessage.to_member == Member.id))
+                .where(Member.group == g.id)
+                .order_by(PMMessage.id)
+                .limit(batch)
+            ]
+            if not ids and not pms:
+                break
+            database = database or shards.open(g.id)
+            move_rows(
+                database,
+                [
+                    (RedirectedMessage, RedirectedMessage.message << ids),
+                    (PackedRedirect, PackedRedirect.message << ids),
+                    (ReplyEntry, ReplyEntry.member << Member.select(Member.id).where(Member.group == g.id)),
+                    (Message, Message.id << ids),
+                    (PMMessage, PMMessage.id << pms),
+                ],
+            )
+            moved += len(ids) + len(pms)
+            await asyncio.sleep(0)
+    if moved:
+        logger.info(f"Moved {moved} messages into per-group database files.")
+    return moved
+
+
+@migration(1)
+async def composite_indexes(m: Migrator):
+    for model in BaseModel.__subclasses__():
+        if model.table_exists():
+            m.add_indexes(model)
+
+
+@migration(2)
+async def ban_group_mask(m: Migrator):
+    m.add_column(BanGroup, "mask")
+
+    def fill(groups: List[BanGroup]):
+        masks = {g.id: 0 for g in groups}
+        e: BanGroupEntry
+        for e in BanGroupEntry.select().where(BanGroupEntry.group << list(masks)):
+            masks[e.group_id] |= BanGroup.bit(e.type)
+        for id, mask in masks.items():
+            BanGroup.update(mask=mask).where(BanGroup.id == id).execute()
+
+    await m.backfill(BanGroup.select(BanGroup.id), fill)
+
+
+@migration(3)
+async def counters(m: Migrator):
+    m.add_column(Group, "member_count")
+    m.add_column(Group, "message_count")
+    m.add_column(Member, "message_count")
+    await m.backfill(Group.select(Group.id), reconcile_counters, batch=20)
+
+
+@migration(4)
+async def reply_index(m: Migrator):
+    """Replaced by lookups on the indexes of the message tables, the table is dropped by migration 10."""
+
+
+@migration(5)
+async def delivery_cursor(m: Migrator):
+    m.add_column(Member, "last_delivered")
+
+    def fill(members: List[Member]):
+        redirected = RedirectedMessage.select(fn.MAX(RedirectedMessage.message)).where(RedirectedMessage.to_member == Member.id)
+        sent = Message.select(fn.MAX(Message.id)).where(Message.member == Member.id)
+        (
+            Member.update(last_delivered=fn.MAX(fn.COALESCE(redirected, 0), fn.COALESCE(sent, 0)))
+            .where(Member.id << [r.id for r in members])
+            .execute()
+        )
+
+    await m.backfill(Member.select(Member.id), fill, batch=500)
+
+
+@migration(6)
+async def packed_redirects(m: Migrator):
+    if not m.dry_run:
+        PackedRedirect.create_table(safe=True)
+    if not PackedRedirect.enabled:
+        return
+
+    def pack(messages: List[Message]):
+        ids = [r.id for r in messages]
+        redirects = {}
+        rm: RedirectedMessage
+        for rm in RedirectedMessage.select(RedirectedMessage.message, RedirectedMessage.to_member, RedirectedMessage.mid).where(
+            RedirectedMessage.message << ids
+        ):
+            redirects.setdefault(rm.message_id, {})[rm.to_member_id] = rm.mid
+        PackedRedirect.merge(redirects)
+        RedirectedMessage.delete().where(RedirectedMessage.message << ids).execute()
+
+    await m.backfill(Message.select(Message.id), pack, batch=200)
+
+
+@migration(7)
+async def retention(m: Migrator):
+    m.add_column(Group, "retention_days")
+    # Converting an existing file rewrites all of it, so it is only done on request by enable_incremental_vacuum().
+    if db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logger.info("Space freed by retention is reused but not returned, run with --vacuum once to enable incremental vacuum.")
+
+
+@migration(8)
+async def drop_redundant_indexes(m: Migrator):
+    m.drop_indexes(DROPPED_INDEXES)
+
+
+@migration(9)
+async def redirect_ranges(m: Migrator):
+    """Replaced by the reply entries of migration 11, the table is dropped by it."""
+
+
+@migration(10)
+async def drop_reply_index(m: Migrator):
+    for table in DROPPED_TABLES:
+        m.execute(f'DROP TABLE IF EXISTS "{table}"')
+
+
+async def reply_entries(m: Migrator):
+    """Fill the reply entries of existing group messages, their redirected copies and private messages."""
+    await m.backfill(Message.select(Message.id, Message.member, Message.mid), ReplyEntry.build, batch=200)
+    await m.backfill(PMMessage.select(PMMessage.id, PMMessage.to_member, PMMessage.redirected_mid), ReplyEntry.build_pms, batch=500)
+
+
+@migration(11)
+async def reply_entry_table(m: Migrator):
+    if not m.dry_run:
+        ReplyEntry.create_table(safe=True)
+    # In dry-run mode, the tables are not created by migration 6 on databases from before it.
+    if PackedRedirect.table_exists():
+        await reply_entries(m)
+    m.execute('DROP TABLE IF EXISTS "redirectrange"')
+
+
+async def upgrade_shards(dry_run=False):
+    """Bring the message tables of existing per-group files to SHARD_VERSION, returns the number of files upgraded."""
+    upgraded = 0
+    for g in Group.select(Group.id):
+        if not shards.path(g.id).exists():
+            continue
+        with shards.use(g.id):
+            database = shards.open(g.id)
+            version = database.execute_sql("PRAGMA user_version").fetchone()[0]
+            if version >= SHARD_VERSION:
+                continue
+            logger.info(f"{'Checking' if dry_run else 'Upgrading'} message tables of group {g.id} from version {version}.")
+            migrator = Migrator(dry_run=dry_run, database=database)
+            if version < 1:
+                await reply_entries(migrator)
+            if not dry_run:
+                database.execute_sql(f"PRAGMA user_version = {SHARD_VERSION}")
+            upgraded += 1
+    return upgraded
+
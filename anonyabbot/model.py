@@ -1,12 +1,21 @@
 from __future__ import annotations
 
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from pathlib import Path
 import random
 import string
-from typing import Iterable, List, Type, Union
+import sys
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple, Type, Union
 
 from aenum import IntEnum
 from peewee import *
+from playhouse.sqlite_ext import AutoIncrementField
 
 from .utils import to_iterable, extract
 
@@ -106,11 +115,304 @@ class EnumField(IntegerField):
         return self.choices(value)
 
 
+class ShardScope:
+    """Group whose message tables are used by a task, which may be known only after the task is started."""
+
+    def __init__(self, group_id: int = None):
+        self.group_id = group_id
+
+
+current_shard: ContextVar[Optional[ShardScope]] = ContextVar("current_shard", default=None)
+
+
+class ShardDatabase(SqliteDatabase):
+    """Database file of a group, whose connections in all threads can be closed at once."""
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, check_same_thread=False, **kw)
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        self.retired = False
+        self.leases = 0
+
+    def _connect(self):
+        if self.retired:
+            raise InterfaceError(f"database file {self.database} is closed")
+        conn = super()._connect()
+        with self.connections_lock:
+            self.connections.add(conn)
+        return conn
+
+    def _close(self, conn):
+        with self.connections_lock:
+            self.connections.discard(conn)
+        super()._close(conn)
+
+    @property
+    def busy(self):
+        with self.connections_lock:
+            return any(c.in_transaction for c in self.connections)
+
+    def close_all(self):
+        """Close connections of every thread, the database is not used afterwards."""
+        self.retired = True
+        with self.connections_lock:
+            connections, self.connections = self.connections, set()
+        for conn in connections:
+            conn.close()
+
+
+class ShardRouter:
+    """
+    Database of the message tables, which is the main database unless per-group files are enabled.
+    Note:
+        With shards enabled, each group keeps its message tables in its own file, selected by the scope of the current task,
+        so that the fan-out writes of a busy group do not hold the write lock of other groups.
+        Queries on message tables must not join tables in the main database.
+        At most `size` files are kept open, the least recently used ones are closed in all threads when more are opened.
+        Files leased by a running database call are only closed once their last lease is released.
+    """
+
+    def __init__(self, main: SqliteDatabase):
+        self.main = main
+        self.enabled = False
+        self.directory: Optional[Path] = None
+        self.pragmas = {}
+        self.size = 64
+        self.databases: OrderedDict[int, ShardDatabase] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def init(self, directory: Union[str, Path], pragmas: dict = None, size: int = 64):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.pragmas = pragmas or {}
+        self.size = size
+
+    def current(self) -> Optional[int]:
+        scope = current_shard.get()
+        return scope.group_id if scope else None
+
+    @contextmanager
+    def use(self, group_id: int):
+        """Select the message tables of a group in this context, which is inherited by tasks and dbio calls."""
+        token = current_shard.set(ShardScope(group_id))
+        try:
+            yield
+        finally:
+            current_shard.reset(token)
+
+    def path(self, group_id: int) -> Path:
+        return self.directory / f"{group_id}.db"
+
+    def exists(self, group_id: int) -> bool:
+        return not self.enabled or group_id in self.databases or self.path(group_id).exists()
+
+    def open(self, group_id: int) -> ShardDatabase:
+        """Get the database file of a group, creating its tables if it is new."""
+        with self.lock:
+            return self._open(group_id)
+
+    def _open(self, group_id: int) -> ShardDatabase:
+        database = self.databases.get(group_id, None)
+        if database is not None:
+            self.databases.move_to_end(group_id)
+            return database
+        new = not self.path(group_id).exists()
+        database = ShardDatabase(str(self.path(group_id)), pragmas=self.pragmas)
+        for model in sharded_models():
+            SchemaManager(model, database).create_all(safe=True)
+        for index in DROPPED_INDEXES:
+            database.execute_sql(f'DROP INDEX IF EXISTS "{index}"')
+        for table in DROPPED_TABLES:
+            database.execute_sql(f'DROP TABLE IF EXISTS "{table}"')
+        if new:
+            self.seed(database, group_id)
+        self.databases[group_id] = database
+        self.evict()
+        return database
+
+    @contextmanager
+    def lease(self, group_id: int):
+        """Keep the file of a group open in this context, so that it is not closed under a query by evict() in another thread."""
+        with self.lock:
+            database = self._open(group_id)
+            database.leases += 1
+        try:
+            yield database
+        finally:
+            with self.lock:
+                database.leases -= 1
+                self.evict()
+
+    def seed(self, database: SqliteDatabase, group_id: int):
+        """Start message ids of a new file above ids already delivered to the group, as delivery cursors compare ids."""
+        last = max(
+            self.main.execute_sql('SELECT MAX("id") FROM "message"').fetchone()[0] or 0,
+            Member.select(fn.MAX(Member.last_delivered)).where(Member.group == group_id).scalar() or 0,
+        )
+        database.execute_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (Message._meta.table_name, last))
+        database.execute_sql(f"PRAGMA user_version = {SHARD_VERSION}")
+
+    def evict(self):
+        """Close the least recently used files over the limit, skipping leased ones and those inside a transaction."""
+        for group_id in list(self.databases)[: max(0, len(self.databases) - self.size)]:
+            database = self.databases[group_id]
+            if not database.leases and not database.busy:
+                del self.databases[group_id]
+                database.close_all()
+
+    def drop(self, group_id: int):
+        """Delete the database file of a group."""
+        with self.lock:
+            database = self.databases.pop(group_id, None)
+        if database:
+            database.close_all()
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{self.path(group_id)}{suffix}").unlink(missing_ok=True)
+
+    def get(self) -> SqliteDatabase:
+        if not self.enabled:
+            return self.main
+        group_id = self.current()
+        if group_id is None:
+            raise OperationalError("no group is selected for the message tables")
+        return self.open(group_id)
+
+    def atomic(self, *args, **kw):
+        return self.get().atomic(*args, **kw)
+
+    def transaction(self, *args, **kw):
+        return self.get().transaction(*args, **kw)
+
+    def savepoint(self):
+        return self.get().savepoint()
+
+    def connection_context(self):
+        return self.get().connection_context()
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+shards = ShardRouter(db)
+
+# Single column indexes of foreign keys which are prefixes of composite indexes, dropped from existing databases.
+DROPPED_INDEXES = ("message_member_id", "redirectedmessage_message_id", "redirectedmessage_to_member_id")
+# Tables no longer used, dropped from existing databases.
+DROPPED_TABLES = ("replyindex", "redirectrange")
+# Schema version of shard files, stored as their user_version, older files are upgraded by migrate.upgrade_shards().
+SHARD_VERSION = 1
+
+
 class BaseModel(Model):
     class Meta:
         database = db
 
 
+def sharded_models() -> List[Type[BaseModel]]:
+    return [m for m in BaseModel.__subclasses__() if m._meta.database is shards]
+
+
+def counted_save(record: BaseModel, kw: dict):
+    """Keep counter columns and tracked activity times, which are written by SQL updates, out of updates of a whole row."""
+    if record._pk is not None and not kw.get("force_insert", False) and kw.get("only", None) is None:
+        excluded = set(record.counters) | set(record.tracked)
+        kw = dict(kw, only=[f for f in record._meta.sorted_fields if f.name not in excluded and not f.primary_key])
+    return kw
+
+
+def reconcile_counters(groups: Iterable[Group] = None):
+    """Recount counter columns from member and message rows, returns the number of groups checked."""
+    groups = list(to_iterable(groups)) if groups is not None else list(Group.select(Group.id))
+    for g in groups:
+        if not shards.exists(g.id):
+            continue
+        with shards.use(g.id):
+            per_member = dict(
+                Message.select(Message.member, fn.COUNT(Message.id)).where(Message.group == g.id).group_by(Message.member).tuples()
+            )
+        with db.atomic():
+            members = Member.select(fn.COUNT(Member.id)).where(Member.group == g.id, Member.role >= MemberRole.GUEST)
+            Group.update(member_count=members, message_count=sum(per_member.values())).where(Group.id == g.id).execute()
+            Member.update(message_count=0).where(Member.group == g.id).execute()
+            for batch in chunked(per_member.items(), 300):
+                ids = [id for id, _ in batch]
+                Member.update(message_count=Case(Member.id, batch)).where(Member.id << ids).execute()
+    return len(groups)
+
+
+class RoleCache:
+    """Active roles of users with their expiry time, loaded once per user from validations."""
+
+    def __init__(self, size: int = 100000):
+        self.size = size
+        self.users: Dict[int, Dict[UserRole, Optional[datetime]]] = {}
+
+    def get(self, user: User):
+        roles = self.users.get(user.id, None)
+        if roles is None:
+            roles = {}
+            v: Validation
+            for v in user.s_validation_for().iterator():
+                if v.role in roles and (roles[v.role] is None or (v.until and v.until < roles[v.role])):
+                    continue
+                roles[v.role] = v.until
+            if len(self.users) >= self.size:
+                self.users.pop(next(iter(self.users)), None)
+            self.users[user.id] = roles
+        return roles
+
+    def validate(self, user: User, roles: Iterable[UserRole]):
+        active = self.get(user)
+        now = datetime.now()
+        for r in to_iterable(roles):
+            if r in active and (active[r] is None or active[r] > now):
+                return True
+        return False
+
+    def invalidate(self, user: User):
+        self.users.pop(user.id, None)
+
+
+role_cache = RoleCache()
+
+
+class ActivityTracker:
+    """
+    Last activity times of records, kept in memory and written to the database in batches.
+    Note:
+        Times read through the tracker are always current, while the database lags behind
+        by at most the interval between two flushes.
+    """
+
+    def __init__(self, model: Type[BaseModel], chunk: int = 300):
+        self.model = model
+        self.chunk = chunk
+        self.pending: Dict[int, datetime] = {}
+
+    def touch(self, record: BaseModel):
+        record.last_activity = self.pending[record.id] = datetime.now()
+
+    def get(self, record: BaseModel) -> datetime:
+        return max(record.last_activity, self.pending.get(record.id, record.last_activity))
+
+    def take(self) -> Dict[int, datetime]:
+        """Swap out pending times, called on the event loop so that touches are not lost to a flush in a thread."""
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def flush(self, pending: Dict[int, datetime] = None):
+        if pending is None:
+            pending = self.take()
+        if pending:
+            field = self.model.last_activity
+            with db.atomic():
+                for batch in chunked(pending.items(), self.chunk):
+                    ids = [id for id, _ in batch]
+                    self.model.update({field: Case(self.model.id, batch)}).where(self.model.id << ids).execute()
+        return len(pending)
+
+
 class User(BaseModel):
     id = AutoField()
     uid = IntegerField(unique=True)
@@ -119,6 +421,10 @@ class User(BaseModel):
     lastname = CharField(index=True, null=True)
     created = DateTimeField(default=datetime.now)
 
+    class Meta:
+        # Profile fields are synced into cached records and flushed later, other instances must not write them back.
+        only_save_dirty = True
+
     @property
     def name(self):
         return " ".join([n for n in (self.firstname, self.lastname) if n])
@@ -176,7 +482,7 @@ class User(BaseModel):
         return cls.s_all_in_role(roles).count()
 
     def validate(self, roles: Iterable[UserRole], fail=False, reversed=False):
-        if self.s_validation_for(roles).count():
+        if role_cache.validate(self, roles):
             result = not reversed
         else:
             result = reversed
@@ -217,6 +523,7 @@ class User(BaseModel):
                 if from_request:
                     from_request.used = validation
                     from_request.save()
+        role_cache.invalidate(self)
 
     def remove_validation(self, roles: Iterable[UserRole] = None):
         count = 0
@@ -226,6 +533,7 @@ class User(BaseModel):
                 v.until = datetime.now()
                 v.save()
                 count += 1
+        role_cache.invalidate(self)
         return count
 
     def create_code(
@@ -259,6 +567,7 @@ class User(BaseModel):
             for r in to_iterable(roles):
                 request = self.create_request(r, days=days)
                 self.add_validation(r, days=days, from_request=request)
+        role_cache.invalidate(self)
 
     def use_code(self, code: str) -> List[ValidationRequest]:
         used = []
@@ -275,6 +584,7 @@ class User(BaseModel):
                 if vc.code == code and not vc.used:
                     self.add_validation(vc.role, days=vc.days, from_request=vc)
                     used.append(vc)
+        role_cache.invalidate(self)
         return used
 
     def member_in(self, group: Group):
@@ -313,6 +623,9 @@ class Validation(BaseModel):
     until = DateTimeField(default=datetime.now, null=True)
     created = DateTimeField(default=datetime.now)
 
+    class Meta:
+        indexes = ((("user", "role", "until"), False),)
+
     @property
     def by(self):
         results = set()
@@ -324,7 +637,7 @@ class Validation(BaseModel):
 
 class ValidationRequest(BaseModel):
     id = AutoField()
-    code = CharField(null=True)
+    code = CharField(null=True, index=True)
     role = EnumField(UserRole, default=UserRole.NONE)
     days = IntegerField(null=True)
     created = DateTimeField(default=datetime.now)
@@ -336,25 +649,64 @@ class BanGroup(BaseModel):
     id = AutoField()
     created = DateTimeField(default=datetime.now)
     until = DateTimeField(default=datetime.now, null=True)
+    mask = BigIntegerField(default=0)
 
     default_types = [BanType.MASK_STR, BanType.INVITE]
 
+    # Ban groups are never modified after creation, so they are cached by id until deleted.
+    _cache: Dict[int, BanGroup] = {}
+
+    @staticmethod
+    def bit(type: BanType):
+        return 1 << type.value
+
+    @classmethod
+    def to_mask(cls, types: Iterable[BanType]):
+        mask = 0
+        for t in to_iterable(types):
+            mask |= cls.bit(t)
+        return mask
+
     @classmethod
     def generate(cls, types: List[BanType] = None, until: datetime = None):
         if types is None:
             types = cls.default_types
-        with db.atomic():
-            group = cls.create(until=until)
-            for t in to_iterable(types):
-                BanGroupEntry.create(type=t, group=group)
+        return cls.create(until=until, mask=cls.to_mask(types))
+
+    @classmethod
+    def cached(cls, id: int) -> Optional[BanGroup]:
+        if id is None:
+            return None
+        group = cls._cache.get(id, None)
+        if group is None:
+            group = cls.get_or_none(id=id)
+            if group:
+                if len(cls._cache) >= 100000:
+                    cls._cache.pop(next(iter(cls._cache)), None)
+                cls._cache[id] = group
         return group
 
+    def has(self, type: BanType):
+        return bool(self.mask & self.bit(type))
+
+    def types(self):
+        return [t for t in BanType if self.has(t)]
+
+    def delete_instance(self, *args, **kw):
+        self._cache.pop(self.id, None)
+        return super().delete_instance(*args, **kw)
+
 
 class BanGroupEntry(BaseModel):
+    """Ban types of a ban group before they were stored in BanGroup.mask, only read by migrations."""
+
     id = AutoField()
     type = EnumField(BanType, default=BanType.NONE)
     group = ForeignKeyField(BanGroup, backref="entries")
 
+    class Meta:
+        indexes = ((("group", "type"), False),)
+
 
 class Group(BaseModel):
     id = AutoField()
@@ -374,48 +726,47 @@ class Group(BaseModel):
     parent = ForeignKeyField('self', backref="subgroups", null=True, default=None)
     password = TextField(null=True, default=None)
     inactive_leave = IntegerField(default=0)
+    retention_days = IntegerField(null=True, default=None)
     private = BooleanField(default=False)
     disabled = BooleanField(default=False)
+    member_count = IntegerField(default=0)
+    message_count = IntegerField(default=0)
+
+    counters = ("member_count", "message_count")
+    tracked = ("last_activity",)
+
+    def save(self, *args, **kw):
+        return super().save(*args, **counted_save(self, kw))
+
+    def counter(self, name: str):
+        return type(self).select(getattr(type(self), name)).where(type(self).id == self.id).scalar() or 0
 
     @property
     def n_members(self):
-        return self.members.where(Member.role >= MemberRole.GUEST).count()
+        return self.counter("member_count")
     
     @property
     def n_members_all(self):
         if self.parent:
             return self.parent.n_members_all
         else:
-            return self.members.where(Member.role >= MemberRole.GUEST).count()
+            return self.n_members
     
     @classmethod
     def get_avg_n_members(cls):
-        query = (
-            Member
-            .select(Member.group, fn.COUNT(Member.id).alias('count'))
-            .where(Member.role >= MemberRole.GUEST)
-            .group_by(Member.group)
-        )
-
-        try:
-            average = sum(q.count for q in query) / len(query)
-        except ZeroDivisionError:
-            return 0
-        else:
-            return average
+        return cls.select(fn.AVG(cls.member_count)).where(cls.member_count > 0).scalar() or 0
 
     @property
     def n_messages(self):
-        return self.messages.count()
+        return self.counter("message_count")
     
     @property
     def is_prime(self):
         return self.creator.is_prime
 
     def default_bans(self):
-        e: BanType
-        for e in self.default_ban_group.entries.iterator():
-            yield e.type
+        for t in BanGroup.cached(self.default_ban_group_id).types():
+            yield t
 
     def s_all_has_role(self, role: MemberRole):
         return self.members.where(Member.role >= role, Member.role >= MemberRole.GUEST)
@@ -442,18 +793,21 @@ class Group(BaseModel):
         else:
             member_ids = [m.id for m in to_iterable(members)]
             m: Message
-            for m in self.messages.join(Member).where(Member.id << member_ids).iterator():
+            for m in self.messages.where(Message.member << member_ids).iterator():
                 yield m
 
+    @property
+    def last_active(self):
+        return group_activity.get(self)
+
     def touch(self):
-        self.last_activity = datetime.now()
-        self.save()
+        group_activity.touch(self)
 
     def cannot(self, ban: BanType, fail=False):
-        group_scope: BanGroupEntry = self.default_ban_group.entries.where(BanGroupEntry.type == ban).get_or_none()
-        if group_scope:
+        group_scope = BanGroup.cached(self.default_ban_group_id)
+        if group_scope.has(ban):
             if fail:
-                raise BanError(type=ban, member=False, until=self.default_ban_group.until)
+                raise BanError(type=ban, member=False, until=group_scope.until)
             return True
         return False
 
@@ -469,7 +823,33 @@ class Member(BaseModel):
     pinned_mask = CharField(null=True, default=None)
     invitor = ForeignKeyField('self', backref="invitees", null=True, default=None)
     ban_group = ForeignKeyField(BanGroup, backref="linked_members", null=True)
-    
+    message_count = IntegerField(default=0)
+    last_delivered = IntegerField(default=0)
+
+    counters = ("message_count", "last_delivered")
+    tracked = ("last_activity",)
+
+    class Meta:
+        indexes = (
+            (("group", "user"), False),
+            (("group", "role"), False),
+        )
+
+    def save(self, *args, **kw):
+        kw = counted_save(self, kw)
+        with db.atomic():
+            joined = self.role >= MemberRole.GUEST
+            if self._pk is None or kw.get("force_insert", False):
+                delta = int(joined)
+            elif "role" in {f.name for f in self.dirty_fields}:
+                before = type(self).select(type(self).role).where(type(self).id == self._pk).scalar()
+                delta = int(joined) - int(before is not None and before >= MemberRole.GUEST)
+            else:
+                delta = 0
+            result = super().save(*args, **kw)
+            if delta:
+                Group.update(member_count=Group.member_count + delta).where(Group.id == self.group_id).execute()
+        return result
 
     @property
     def is_banned(self):
@@ -477,11 +857,14 @@ class Member(BaseModel):
 
     @property
     def n_messages(self):
-        return self.messages.count()
+        return type(self).select(type(self).message_count).where(type(self).id == self.id).scalar() or 0
+
+    @property
+    def last_active(self):
+        return member_activity.get(self)
 
     def touch(self):
-        self.last_activity = datetime.now()
-        self.save()
+        member_activity.touch(self)
 
     def validate(self, role: MemberRole, fail=False, reversed=False):
         current_role = self.role
@@ -489,7 +872,7 @@ class Member(BaseModel):
             if current_role < MemberRole.ADMIN_ADMIN:
                 current_role = MemberRole.ADMIN_ADMIN
         if self.group.inactive_leave:
-            if self.last_activity < datetime.now() - timedelta(days=self.group.inactive_leave):
+            if self.last_active < datetime.now() - timedelta(days=self.group.inactive_leave):
                 if current_role < MemberRole.ADMIN:
                     current_role = MemberRole.LEFT
         if not reversed:
@@ -510,41 +893,37 @@ class Member(BaseModel):
     def check_ban(self, ban: BanType, fail=True, check_group=True):
         if self.validate(MemberRole.ADMIN):
             return False
-        if self.ban_group:
-            member_scope: BanGroupEntry = self.ban_group.entries.where(BanGroupEntry.type == ban).get_or_none()
-            if member_scope:
-                if fail:
-                    raise BanError(type=ban, member=True, until=self.ban_group.until)
-                return True
+        member_scope = BanGroup.cached(self.ban_group_id)
+        if member_scope and member_scope.has(ban):
+            if fail:
+                raise BanError(type=ban, member=True, until=member_scope.until)
+            return True
         if check_group:
-            group_scope: BanGroupEntry = self.group.default_ban_group.entries.where(BanGroupEntry.type == ban).get_or_none()
-            if group_scope:
-                if fail:
-                    raise BanError(type=ban, member=False, until=self.group.default_ban_group.until)
-                return True
+            return self.group.cannot(ban, fail=fail)
         return False
             
+    @classmethod
+    def advance(cls, member_ids: Iterable[int], message_id: int):
+        """Move the delivery cursor of members to message_id, if they are behind it."""
+        with db.atomic():
+            for batch in chunked(list(member_ids), 500):
+                cls.update(last_delivered=fn.MAX(cls.last_delivered, message_id)).where(cls.id << batch).execute()
+
     def not_redirected_messages(self, limit: int = 10, days: int = 7):
         results = []
-        for m in self.group.messages.order_by(Message.created.desc()).iterator():
-            if m.get_redirect_for(self) is None:
-                results.append(m)
-                if len(results) >= limit:
-                    break
-                if m.created < datetime.now() - timedelta(days=days):
-                    break
-            else:
+        query = (
+            self.group.messages.where(Message.id > self.last_delivered, Message.member != self.id)
+            .order_by(Message.id.desc())
+            .limit(limit)
+        )
+        for m in query.iterator():
+            results.append(m)
+            if m.created < datetime.now() - timedelta(days=days):
                 break
         return results
     
     def not_redirected_pinned_messages(self):
-        results = []
-        for m in self.group.messages.where(Message.pinned == True).order_by(Message.created.desc()).iterator():
-            if m.get_redirect_for(self) is None:
-                results.append(m)
-            else:
-                break
-        return results
+        return list(self.s_pinned_messages().where(Message.id > self.last_delivered, Message.member != self.id))
     
     def s_pinned_messages(self):
         return self.group.messages.where(Message.pinned == True).order_by(Message.created.desc())
@@ -554,31 +933,231 @@ class Member(BaseModel):
             yield m
 
 class Message(BaseModel):
-    id = AutoField()
+    id = AutoIncrementField()
     group = ForeignKeyField(Group, backref="messages")
     mid = IntegerField(index=True)
-    member = ForeignKeyField(Member, backref="messages")
+    member = ForeignKeyField(Member, backref="messages", index=False)
     mask = CharField()
     reply_to = ForeignKeyField('self', backref="replying_messages", null=True)
     pinned = BooleanField(default=False)
     updated = DateTimeField(default=datetime.now)
     created = DateTimeField(default=datetime.now)
 
+    class Meta:
+        database = shards
+        indexes = (
+            (("member", "mid"), False),
+            (("group", "created"), False),
+            (("group", "pinned", "created"), False),
+        )
+
+    def save(self, *args, **kw):
+        with shards.atomic():
+            created = self._pk is None or kw.get("force_insert", False)
+            result = super().save(*args, **kw)
+            if created:
+                ReplyEntry.add([{"member": self.member_id, "mid": self.mid, "message": self.id}])
+                ReplyIndex.remember(self.member_id, self.mid, self)
+        return result
+
+    def add_to_counters(self):
+        """Count a new message on its group and member, which are written separately as they are in the main database."""
+        with db.atomic():
+            Group.update(message_count=Group.message_count + 1).where(Group.id == self.group_id).execute()
+            Member.update(message_count=Member.message_count + 1).where(Member.id == self.member_id).execute()
+
     def get_redirect_for(self, member: Member):
-        if member.id == self.member.id:
+        """
+        Get the redirected copy of this message in the private chat of the member.
+        Note:
+            Both storages are looked up, so that messages stored before database.redirect_storage is changed can still be found.
+        """
+        if member.id == self.member_id:
             return self
-        else:
-            rm: RedirectedMessage = self.redirects.join(Member).where(Member.id == member.id).get_or_none()
-            return rm
+        lookups = [self._packed_redirect_for, self._row_redirect_for]
+        if not PackedRedirect.enabled:
+            lookups.reverse()
+        for lookup in lookups:
+            rm = lookup(member)
+            if rm:
+                return rm
+        return None
+
+    def get_redirects_for(self, members: Iterable[Member]) -> Dict[int, Union[Message, RedirectedMessage]]:
+        """Get the copies of this message in the private chats of members by member id, preferring storages as get_redirect_for()."""
+        members = {m.id: m for m in members}
+        copies = {}
+        if self.member_id in members:
+            copies[self.member_id] = self
+        rm: RedirectedMessage
+        for rm in self.redirects:
+            if rm.to_member_id in members:
+                rm.to_member = members[rm.to_member_id]
+                copies[rm.to_member_id] = rm
+        data = PackedRedirect.select(PackedRedirect.data).where(PackedRedirect.message == self.id).scalar()
+        if data is not None:
+            for member_id, mid in PackedRedirect.unpack(bytes(data)).items():
+                if member_id in members and (PackedRedirect.enabled or member_id not in copies):
+                    copies[member_id] = RedirectedMessage(mid=mid, message=self, to_member=members[member_id])
+        return copies
+
+    def _row_redirect_for(self, member: Member):
+        return self.redirects.where(RedirectedMessage.to_member == member.id).get_or_none()
+
+    def _packed_redirect_for(self, member: Member):
+        mid = PackedRedirect.lookup(self, member.id)
+        if mid is not None:
+            return RedirectedMessage(mid=mid, message=self, to_member=member)
 
 
 class RedirectedMessage(BaseModel):
     id = AutoField()
     mid = IntegerField(index=True)
-    message = ForeignKeyField(Message, backref="redirects")
-    to_member = ForeignKeyField(Member, backref="redirected_messages")
+    message = ForeignKeyField(Message, backref="redirects", index=False)
+    to_member = ForeignKeyField(Member, backref="redirected_messages", index=False)
     created = DateTimeField(default=datetime.now)
 
+    class Meta:
+        database = shards
+        indexes = (
+            (("to_member", "mid"), False),
+            (("message", "to_member"), False),
+        )
+
+
+class PackedRedirect(BaseModel):
+    """
+    Redirected copies of a message, packed in one blob instead of one RedirectedMessage row per member.
+    Note:
+        The blob is an array of sorted member ids followed by an array of their message ids, as little-endian uint32,
+        so that the message id of a member is found by binary search without unpacking the blob.
+        This storage is used when database.redirect_storage is "packed".
+    """
+
+    message = ForeignKeyField(Message, primary_key=True, backref="+")
+    data = BlobField()
+
+    class Meta:
+        database = shards
+
+    enabled = False
+    size = 64
+    _recent: OrderedDict = OrderedDict()
+    _generation = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def pack(redirects: Dict[int, int]) -> bytes:
+        members = sorted(redirects)
+        data = array("I", members)
+        data.extend(redirects[m] for m in members)
+        if sys.byteorder != "little":
+            data.byteswap()
+        return data.tobytes()
+
+    @staticmethod
+    def unpack(data: bytes) -> Dict[int, int]:
+        values = array("I")
+        values.frombytes(data)
+        if sys.byteorder != "little":
+            values.byteswap()
+        n = len(values) // 2
+        return dict(zip(values[:n], values[n:]))
+
+    @classmethod
+    def search(cls, data: bytes, member_id: int) -> Optional[int]:
+        if sys.byteorder != "little":
+            return cls.unpack(data).get(member_id, None)
+        values = memoryview(data).cast("I")
+        n = len(values) // 2
+        i = bisect_left(values, member_id, 0, n)
+        if i < n and values[i] == member_id:
+            return values[n + i]
+        return None
+
+    @classmethod
+    def lookup(cls, message: Message, member_id: int) -> Optional[int]:
+        """Get the message id of the redirected copy of a message for a member."""
+        key = (message.group_id, message.id)
+        with cls._lock:
+            data = cls._recent.get(key, None)
+            if data is not None:
+                cls._recent.move_to_end(key)
+            generation = cls._generation
+        if data is None:
+            data = cls.select(cls.data).where(cls.message == message.id).scalar()
+            if data is None:
+                return None
+            data = bytes(data)
+            with cls._lock:
+                if generation == cls._generation:
+                    cls._recent[key] = data
+                    if len(cls._recent) > cls.size:
+                        cls._recent.popitem(last=False)
+        return cls.search(data, member_id)
+
+    @classmethod
+    def forget(cls, keys: Iterable[Tuple[int, int]]):
+        """Drop cached blobs of messages by (group id, message id), called after their changes are committed."""
+        with cls._lock:
+            cls._generation += 1
+            for key in keys:
+                cls._recent.pop(key, None)
+
+    @classmethod
+    def merge(cls, redirects: Dict[int, Dict[int, int]]):
+        """Add redirected copies, as message id -> (member id -> message id), to the blobs of their messages."""
+        for batch in chunked(list(redirects), 200):
+            existing = {p.message_id: p.data for p in cls.select().where(cls.message << batch)}
+            rows = []
+            for id in batch:
+                pairs = cls.unpack(existing[id]) if id in existing else {}
+                pairs.update(redirects[id])
+                rows.append({"message": id, "data": cls.pack(pairs)})
+            cls.insert_many(rows).on_conflict_replace().execute()
+
+
+group_activity = ActivityTracker(Group)
+member_activity = ActivityTracker(Member)
+
+
+class RedirectBuffer:
+    """Collect redirected messages in memory and insert them in one transaction on flush."""
+
+    def __init__(self, chunk: int = 200):
+        self.chunk = chunk
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, mid: int, message: Message, to_member: Member):
+        self.rows.append({"mid": mid, "message": message, "to_member": to_member, "created": datetime.now()})
+        ReplyIndex.remember(to_member.id, mid, message)
+
+    def take(self) -> List[dict]:
+        """Swap out buffered rows, called on the event loop so that rows added meanwhile are not lost to a flush in a thread."""
+        rows, self.rows = self.rows, []
+        return rows
+
+    def flush(self, rows: List[dict] = None):
+        if rows is None:
+            rows = self.take()
+        if rows:
+            packed = {}
+            with shards.atomic():
+                ReplyEntry.add([{"member": r["to_member"].id, "mid": r["mid"], "message": r["message"].id} for r in rows])
+                if PackedRedirect.enabled:
+                    for r in rows:
+                        packed.setdefault(r["message"].id, {})[r["to_member"].id] = r["mid"]
+                    PackedRedirect.merge(packed)
+                else:
+                    for batch in chunked(rows, self.chunk):
+                        RedirectedMessage.insert_many(batch).execute()
+            if packed:
+                PackedRedirect.forget((r["message"].group_id, r["message"].id) for r in rows)
+        return len(rows)
+
 
 class PMBan(BaseModel):
     id = AutoField()
@@ -593,4 +1172,134 @@ class PMMessage(BaseModel):
     to_member = ForeignKeyField(Member, backref="received_pm_messages")
     mid = IntegerField(index=True)
     redirected_mid = IntegerField(index=True)
-    time = DateTimeField(default=datetime.now)
\ No newline at end of file
+    time = DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = shards
+        indexes = ((("to_member", "redirected_mid"), False),)
+
+    def save(self, *args, **kw):
+        with shards.atomic():
+            created = self._pk is None or kw.get("force_insert", False)
+            result = super().save(*args, **kw)
+            if created:
+                ReplyEntry.add([{"member": self.to_member_id, "mid": self.redirected_mid, "pm": self.id}])
+                ReplyIndex.remember(self.to_member_id, self.redirected_mid, self)
+        return result
+
+
+class ReplyEntry(BaseModel):
+    """
+    Origin of a message in the private chat of a member, which is a group message or a private message.
+    Note:
+        This is the single table replies are resolved from. Rows are keyed by (member, mid) without a rowid,
+        so the table is one b-tree of a few integers per copy, for both storages of redirected copies.
+    """
+
+    member = ForeignKeyField(Member, backref="+", index=False)
+    mid = IntegerField()
+    message = ForeignKeyField(Message, backref="+", null=True, index=False)
+    pm = ForeignKeyField(PMMessage, backref="+", null=True, index=False)
+
+    class Meta:
+        database = shards
+        primary_key = CompositeKey("member", "mid")
+        without_rowid = True
+
+    @classmethod
+    def add(cls, entries: List[dict]):
+        for batch in chunked(entries, 300):
+            cls.insert_many(batch).on_conflict_replace().execute()
+
+    @classmethod
+    def remove(cls, keys: Iterable[Tuple[int, int]]):
+        """Delete entries by (member id, mid), grouped by member so that each delete is a range of the primary key."""
+        mids: Dict[int, List[int]] = {}
+        for member_id, mid in keys:
+            mids.setdefault(member_id, []).append(mid)
+        for member_id, values in mids.items():
+            for batch in chunked(values, 300):
+                cls.delete().where(cls.member == member_id, cls.mid << batch).execute()
+
+    @staticmethod
+    def copies(messages: List[Message]) -> List[Tuple[int, int, int]]:
+        """Get (member id, mid, message id) of group messages in the chats of their senders and of their redirected copies."""
+        ids = [m.id for m in messages]
+        copies = [(m.member_id, m.mid, m.id) for m in messages]
+        rows = RedirectedMessage.select(RedirectedMessage.to_member, RedirectedMessage.mid, RedirectedMessage.message)
+        copies.extend(rows.where(RedirectedMessage.message << ids).tuples())
+        for p in PackedRedirect.select().where(PackedRedirect.message << ids):
+            copies.extend((member_id, mid, p.message_id) for member_id, mid in PackedRedirect.unpack(bytes(p.data)).items())
+        return copies
+
+    @classmethod
+    def build(cls, messages: List[Message]):
+        """Add entries of group messages and their redirected copies, used to fill the table for existing messages."""
+        cls.add([{"member": member_id, "mid": mid, "message": id} for member_id, mid, id in cls.copies(messages)])
+
+    @classmethod
+    def build_pms(cls, pms: List[PMMessage]):
+        cls.add([{"member": p.to_member_id, "mid": p.redirected_mid, "pm": p.id} for p in pms])
+
+
+class ReplyIndex:
+    """
+    Origin of each message in the private chat of a member, which is a group message or a private message.
+    Note:
+        Origins are looked up in the reply entries, and recent ones are cached in memory, including misses.
+    """
+
+    size = 50000
+    _recent: OrderedDict = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def remember(cls, member_id: int, mid: int, origin: Union[Message, PMMessage]):
+        with cls._lock:
+            cls._recent[(member_id, mid)] = origin
+            cls._recent.move_to_end((member_id, mid))
+            if len(cls._recent) > cls.size:
+                cls._recent.popitem(last=False)
+
+    @classmethod
+    def lookup(cls, member: Member, mid: int) -> Union[Message, PMMessage, None]:
+        """Get the origin from the reply entries in one query on their primary key."""
+        entry = (
+            ReplyEntry.select(ReplyEntry, Message, PMMessage)
+            .join(Message, JOIN.LEFT_OUTER, on=(ReplyEntry.message == Message.id))
+            .switch(ReplyEntry)
+            .join(PMMessage, JOIN.LEFT_OUTER, on=(ReplyEntry.pm == PMMessage.id))
+            .where(ReplyEntry.member == member.id, ReplyEntry.mid == mid)
+            .get_or_none()
+        )
+        if not entry:
+            return None
+        # Origins missing from the joins are None.
+        return entry.message if entry.message_id else entry.pm
+
+    @classmethod
+    def resolve(cls, member: Member, mid: int) -> Union[Message, PMMessage, None]:
+        """Get the origin of a message in the private chat of the member, misses are cached as well."""
+        key = (member.id, mid)
+        with cls._lock:
+            if key in cls._recent:
+                cls._recent.move_to_end(key)
+                return cls._recent[key]
+        origin = cls.lookup(member, mid)
+        with cls._lock:
+            # An origin remembered by a concurrent save is newer than the result of the lookup.
+            if not (origin is None and cls._recent.get(key, None)):
+                cls._recent[key] = origin
+                cls._recent.move_to_end(key)
+                if len(cls._recent) > cls.size:
+                    cls._recent.popitem(last=False)
+        return origin
+
+    @classmethod
+    def forget(cls, messages: Iterable[int] = (), pms: Iterable[int] = ()):
+        """Drop cached origins which are deleted, given ids of group messages and private messages."""
+        messages, pms = set(messages), set(pms)
+        with cls._lock:
+            for key, origin in list(cls._recent.items()):
+                if origin is not None and origin.id in (messages if isinstance(origin, Message) else pms):
+                    del cls._recent[key]
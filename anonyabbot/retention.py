@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+from typing import Dict
+
+from loguru import logger
+from peewee import fn
+
+from . import dbio
+from .config import config
+from .model import Group, Member, Message, PackedRedirect, PMMessage, RedirectedMessage, ReplyEntry, ReplyIndex, db, shards
+
+
+def retention_days(group: Group) -> int:
+    """Days to keep messages of a group, 0 means forever."""
+    if group.retention_days is not None:
+        return group.retention_days
+    return config.get("database.retention_days", 0)
+
+
+def prune_messages(group_id: int, cutoff: datetime, batch: int) -> Dict[int, int]:
+    """
+    Delete a batch of group messages created before cutoff, with their redirected copies, returns the number deleted per member.
+    Note:
+        Pinned messages and messages which are replied to are kept, so that they can still be unpinned or quoted.
+    """
+    reply = Message.alias()
+    ids = [
+        m.id
+        for m in Message.select(Message.id)
+        .where(
+            Message.group == group_id,
+            Message.created < cutoff,
+            Message.pinned == False,
+            ~fn.EXISTS(reply.select(reply.id).where(reply.reply_to == Message.id)),
+        )
+        .order_by(Message.id)
+        .limit(batch)
+    ]
+    if not ids:
+        return {}
+    with shards.atomic():
+        per_member = dict(
+            Message.select(Message.member, fn.COUNT(Message.id)).where(Message.id << ids).group_by(Message.member).tuples()
+        )
+        messages = list(Message.select(Message.id, Message.member, Message.mid).where(Message.id << ids))
+        ReplyEntry.remove((member_id, mid) for member_id, mid, _ in ReplyEntry.copies(messages))
+        RedirectedMessage.delete().where(RedirectedMessage.message << ids).execute()
+        PackedRedirect.delete().where(PackedRedirect.message << ids).execute()
+        Message.delete().where(Message.id << ids).execute()
+    PackedRedirect.forget((group_id, id) for id in ids)
+    ReplyIndex.forget(messages=ids)
+    return per_member
+
+
+def uncount_messages(group_id: int, per_member: Dict[int, int]):
+    """Subtract deleted messages from the counters of their group and members."""
+    with db.atomic():
+        for member_id, n in per_member.items():
+            Member.update(message_count=Member.message_count - n).where(Member.id == member_id).execute()
+        Group.update(message_count=Group.message_count - sum(per_member.values())).where(Group.id == group_id).execute()
+
+
+def prune_pm_messages(group_id: int, cutoff: datetime, batch: int) -> int:
+    """Delete a batch of private messages between members of a group sent before cutoff, returns the number deleted."""
+    query = PMMessage.select(PMMessage.id, PMMessage.to_member, PMMessage.redirected_mid).where(PMMessage.time < cutoff)
+    if not shards.enabled:
+        query = query.join(Member, on=(PMMessage.to_member == Member.id)).where(Member.group == group_id)
+    pms = list(query.order_by(PMMessage.id).limit(batch))
+    if not pms:
+        return 0
+    ids = [p.id for p in pms]
+    with shards.atomic():
+        ReplyEntry.remove((p.to_member_id, p.redirected_mid) for p in pms)
+        PMMessage.delete().where(PMMessage.id << ids).execute()
+    ReplyIndex.forget(pms=ids)
+    return len(ids)
+
+
+def reclaim():
+    """Return freed pages to the file system and truncate the write-ahead log."""
+    # A single step of the sqlite3 cursor frees only one page, while executescript runs the pragma to completion.
+    shards.connection().executescript("PRAGMA incremental_vacuum;")
+    shards.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+async def prune() -> int:
+    """Delete expired messages of all groups in small write transactions, returns the number of rows deleted."""
+    batch = config.get("database.retention_batch", 500)
+    total = 0
+    groups = await dbio.io.read(lambda: list(Group.select(Group.id, Group.retention_days)))
+    for group in groups:
+        days = retention_days(group)
+        if not days or not shards.exists(group.id):
+            continue
+        cutoff = datetime.now() - timedelta(days=days)
+        deleted = 0
+        with shards.use(group.id):
+            while True:
+                # Message tables and counters are in different files when shards are enabled, each written by its own writer.
+                per_member = await dbio.io.write_shard(prune_messages, group.id, cutoff, batch)
+                n = sum(per_member.values())
+                if n:
+                    await dbio.io.write(uncount_messages, group.id, per_member)
+                deleted += n
+                if n < batch:
+                    break
+            while True:
+                n = await dbio.io.write_shard(prune_pm_messages, group.id, cutoff, batch)
+                deleted += n
+                if n < batch:
+                    break
+            if deleted and shards.enabled:
+                await dbio.io.write_shard(reclaim)
+        total += deleted
+    if total:
+        if not shards.enabled:
+            await dbio.io.write(reclaim)
+        logger.info(f"Deleted {total} expired messages.")
+    return total
@@ -0,0 +1,41 @@
+import pytest
+
+from anonyabbot.config import config
+from anonyabbot.model import BanGroup, BaseModel, Group, Member, MemberRole, User, db
+
+
+@pytest.fixture
+def database(tmp_path):
+    """An empty main database with the current schema."""
+    db.init(str(tmp_path / "test.db"), pragmas={"journal_mode": "wal"})
+    db.create_tables(BaseModel.__subclasses__())
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def settings(tmp_path):
+    """An empty config file, so that settings read by the code under test take their defaults."""
+    path = tmp_path / "config.toml"
+    path.touch()
+    config.reload_conf(conf_file=path)
+    yield config
+    config._observer.stop()
+    config._conf_file = None
+    config.reset()
+
+
+def create_group(n: int):
+    """Create a group with a creator and n members, returns the group and its members."""
+    creator = User.create(uid=1)
+    group = Group.create(uid=2, token="token", username="group", creator=creator, default_ban_group=BanGroup.generate())
+    members = [Member.create(group=group, user=creator, role=MemberRole.CREATOR)]
+    with db.atomic():
+        for i in range(n):
+            members.append(Member.create(group=group, user=User.create(uid=100 + i), role=MemberRole.MEMBER))
+    return group, members
+
+
+@pytest.fixture
+def group(database):
+    return create_group(5)
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from anonyabbot import migrate
+from anonyabbot.model import DROPPED_INDEXES, Member, Message, RedirectedMessage, UserRole, Validation, ValidationRequest
+
+
+def plan(query):
+    sql, params = query.sql()
+    return " | ".join(r[-1] for r in query.model._meta.database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def indexes(database):
+    return {r[0] for r in database.execute_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        (lambda: Message.select().where(Message.member == 1, Message.mid == 2), "message_member_id_mid"),
+        (lambda: Message.select(Message.id).where(Message.member == 1), "message_member_id_mid"),
+        (lambda: RedirectedMessage.select().where(RedirectedMessage.to_member == 1, RedirectedMessage.mid == 2), "redirectedmessage_to_member_id_mid"),
+        (lambda: RedirectedMessage.select().where(RedirectedMessage.to_member == 1), "redirectedmessage_to_member_id_mid"),
+        (lambda: RedirectedMessage.select().where(RedirectedMessage.message == 1, RedirectedMessage.to_member == 2), "redirectedmessage_message_id_to_member_id"),
+        (lambda: RedirectedMessage.delete().where(RedirectedMessage.message << [1, 2]), "redirectedmessage_message_id_to_member_id"),
+        (lambda: Member.select().where(Member.group == 1, Member.user == 2), "member_group_id_user_id"),
+        (
+            lambda: Validation.select().where(
+                Validation.user == 1,
+                Validation.role << [UserRole.ADMIN, UserRole.CREATOR],
+                (Validation.until > datetime.now()) | (Validation.until.is_null()),
+            ),
+            "validation_user_id_role_until",
+        ),
+        (lambda: ValidationRequest.select().where(ValidationRequest.code == "x"), "validationrequest_code"),
+    ],
+)
+def test_lookups_use_composite_indexes(database, query, index):
+    assert f"INDEX {index}" in plan(query())
+
+
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        (lambda: Message.select().where(Message.group == 1).order_by(Message.created), "message_group_id_created"),
+        (
+            lambda: Message.select().where(Message.group == 1, Message.pinned == True).order_by(Message.created.desc()),
+            "message_group_id_pinned_created",
+        ),
+    ],
+)
+def test_ordered_scans_use_indexes(database, query, index):
+    result = plan(query())
+    assert f"INDEX {index}" in result
+    assert "TEMP B-TREE" not in result
+
+
+def test_redundant_indexes_are_not_created(database):
+    assert not indexes(database) & set(DROPPED_INDEXES)
+
+
+def test_migration_drops_redundant_indexes(database):
+    for name, table, column in (
+        ("message_member_id", "message", "member_id"),
+        ("redirectedmessage_message_id", "redirectedmessage", "message_id"),
+        ("redirectedmessage_to_member_id", "redirectedmessage", "to_member_id"),
+    ):
+        database.execute_sql(f'CREATE INDEX "{name}" ON "{table}" ("{column}")')
+    migrate.stamp()
+    database.execute_sql("DELETE FROM schemaversion WHERE version >= 8")
+    asyncio.run(migrate.upgrade())
+    assert not migrate.pending()
+    assert not indexes(database) & set(DROPPED_INDEXES)
+    assert "INDEX redirectedmessage_to_member_id_mid" in plan(RedirectedMessage.select().where(RedirectedMessage.to_member == 1))
@@ -0,0 +1,45 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from anonyabbot import migrate
+from anonyabbot.model import db
+
+# Schema created by the models before versioned migrations were added.
+SCHEMA = Path(__file__).parent / "data" / "schema_v0.sql"
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    db.init(str(tmp_path / "old.db"), pragmas={"journal_mode": "wal"})
+    db.connect()
+    db.connection().executescript(SCHEMA.read_text())
+    yield db
+    db.close()
+
+
+def tables():
+    return {r[0] for r in db.execute_sql("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_dry_run_on_old_schema(old_database):
+    before = tables()
+    assert asyncio.run(migrate.upgrade(dry_run=True)) == len(migrate.migrations)
+    assert tables() == before
+    assert migrate.current_version() == 0
+
+
+def test_upgrade_old_schema(old_database):
+    assert asyncio.run(migrate.upgrade()) == len(migrate.migrations)
+    assert migrate.current_version() == migrate.migrations[-1].version
+    assert {"packedredirect", "replyentry"} <= tables()
+    assert not {"replyindex", "redirectrange"} & tables()
+
+
+def test_incremental_vacuum_is_opt_in(old_database):
+    asyncio.run(migrate.upgrade())
+    assert db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] == 0
+    assert migrate.enable_incremental_vacuum()
+    assert db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert not migrate.enable_incremental_vacuum()
@@ -0,0 +1,162 @@
+from datetime import datetime, timedelta
+import os
+import random
+
+import pytest
+
+from anonyabbot.model import (
+    Message,
+    PackedRedirect,
+    PMMessage,
+    RedirectBuffer,
+    ReplyEntry,
+    ReplyIndex,
+    db,
+    BaseModel,
+)
+from anonyabbot.retention import prune_messages
+
+from .conftest import create_group
+
+
+@pytest.fixture(params=[False, True], ids=["rows", "packed"])
+def packed(request):
+    PackedRedirect.enabled = request.param
+    yield request.param
+    PackedRedirect.enabled = False
+    PackedRedirect.forget(list(PackedRedirect._recent))
+
+
+def broadcast(group, members, n: int, created: datetime = None):
+    """Create n messages of the first member and redirect them to the others, the copy of message m for member r has id 1000 * r + m."""
+    buffer = RedirectBuffer()
+    messages = []
+    sent = Message.select().where(Message.member == members[0]).count()
+    for i in range(n):
+        m = Message.create(group=group, mid=sent + i + 1, member=members[0], mask="x", created=created or datetime.now())
+        for r in members[1:]:
+            buffer.add(1000 * r.id + m.id, m, r)
+        messages.append(m)
+    buffer.flush()
+    return messages
+
+
+def test_replies_are_resolved_from_storage(group, packed):
+    group, members = group
+    messages = broadcast(group, members, 40)
+    pm = PMMessage.create(from_member=members[1], to_member=members[2], mid=5, redirected_mid=99999)
+    ReplyIndex._recent.clear()
+    for m in messages[::7]:
+        for r in members[1:]:
+            assert ReplyIndex.resolve(r, 1000 * r.id + m.id) == m
+    assert ReplyIndex.resolve(members[0], messages[3].mid) == messages[3]
+    assert ReplyIndex.resolve(members[2], 99999) == pm
+    assert ReplyIndex.resolve(members[1], 123456) is None
+
+
+def test_pruned_messages_drop_their_entries(group, packed):
+    group, members = group
+    old = broadcast(group, members, 40, created=datetime.now() - timedelta(days=10))
+    new = broadcast(group, members, 8)
+    assert prune_messages(group.id, datetime.now() - timedelta(days=1), batch=100) == {members[0].id: len(old)}
+    assert ReplyEntry.select().count() == len(new) * len(members)
+    ReplyIndex._recent.clear()
+    assert ReplyIndex.resolve(members[1], 1000 * members[1].id + old[-1].id) is None
+    assert ReplyIndex.resolve(members[1], 1000 * members[1].id + new[-1].id) == new[-1]
+
+
+def test_missed_lookup_is_one_query(group, packed, monkeypatch):
+    group, members = group
+    broadcast(group, members, 10)
+    ReplyIndex._recent.clear()
+    queries = []
+    execute_sql = db.execute_sql
+    monkeypatch.setattr(db, "execute_sql", lambda sql, *args, **kw: queries.append(sql) or execute_sql(sql, *args, **kw))
+    assert ReplyIndex.resolve(members[1], 123456) is None
+    assert len(queries) == 1
+    assert ReplyIndex.resolve(members[1], 123456) is None
+    assert len(queries) == 1
+
+
+def test_copies_are_resolved_in_bulk(group, packed):
+    group, members = group
+    m = broadcast(group, members[:-1], 1)[0]
+    copies = m.get_redirects_for(members)
+    assert set(copies) == {r.id for r in members[:-1]}
+    for r in members:
+        copy = m.get_redirect_for(r)
+        assert (copies[r.id].mid if r.id in copies else None) == (copy.mid if copy else None)
+
+
+def test_rows_added_during_a_flush_are_kept(group, packed):
+    group, members = group
+    buffer = RedirectBuffer()
+    m = Message.create(group=group, mid=1, member=members[0], mask="x")
+    buffer.add(1001, m, members[1])
+    rows = buffer.take()
+    buffer.add(1002, m, members[2])
+    buffer.flush(rows)
+    assert len(buffer) == 1
+    buffer.flush()
+    ReplyIndex._recent.clear()
+    assert ReplyIndex.resolve(members[2], 1002) == m
+
+
+def storage_size(tables):
+    rows = db.execute_sql("SELECT name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')").fetchall()
+    names = {name for name, table in rows if table in tables}
+    sizes = dict(db.execute_sql("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall())
+    return sum(sizes.get(name, 0) for name in names)
+
+
+@pytest.mark.parametrize("storage", ["rows", "packed"])
+def test_redirect_storage(benchmark, tmp_path, storage):
+    """Storage of redirected copies including the reverse index of replies, and the time to resolve an uncached reply."""
+    db.init(str(tmp_path / f"{storage}.db"))
+    db.create_tables(BaseModel.__subclasses__())
+    try:
+        db.execute_sql("SELECT 1 FROM dbstat LIMIT 1")
+    except Exception:
+        pytest.skip("SQLite is built without the dbstat table")
+    PackedRedirect.enabled = storage == "packed"
+    try:
+        group, members = create_group(200)
+        messages = broadcast(group, members, 300)
+        db.execute_sql("VACUUM")
+        benchmark.extra_info["bytes"] = size = storage_size({"redirectedmessage", "packedredirect", "replyentry"})
+        benchmark.extra_info["bytes_per_copy"] = size / (len(messages) * (len(members) - 1))
+
+        def resolve():
+            ReplyIndex._recent.clear()
+            PackedRedirect.forget(list(PackedRedirect._recent))
+            m, r = random.choice(messages), random.choice(members[1:])
+            assert ReplyIndex.resolve(r, 1000 * r.id + m.id) == m
+
+        benchmark(resolve)
+    finally:
+        PackedRedirect.enabled = False
+        db.close()
+
+
+@pytest.mark.parametrize("storage", ["rows", "packed"])
+def test_redirect_flush_speed(benchmark, tmp_path, storage):
+    """Time to flush the redirected copies of one message sent to 200 members, with their reply entries."""
+    db.init(str(tmp_path / f"{storage}.db"), pragmas={"journal_mode": "wal", "synchronous": "normal"})
+    db.create_tables(BaseModel.__subclasses__())
+    PackedRedirect.enabled = storage == "packed"
+    try:
+        group, members = create_group(200)
+        sent = iter(range(1, 1000000))
+
+        def setup():
+            buffer = RedirectBuffer()
+            m = Message.create(group=group, mid=next(sent), member=members[0], mask="x")
+            for r in members[1:]:
+                buffer.add(1000 * r.id + m.id, m, r)
+            return (buffer,), {}
+
+        benchmark.pedantic(lambda buffer: buffer.flush(), setup=setup, rounds=50)
+        benchmark.extra_info["copies_per_flush"] = len(members) - 1
+    finally:
+        PackedRedirect.enabled = False
+        db.close()
@@ -0,0 +1,148 @@
+import librosa
+import numpy as np
+import pytest
+
+from anonyabbot.bot.group import rosautils
+
+SR = rosautils._sr
+
+EFFECTS = {
+    "change_pitch": 4,
+    "change_speed": 1.2,
+    "change_sample": 1.2,
+    "change_reback": 3,
+    "change_pitchspeed": 1.2,
+    "change_attention": 10,
+    "change_male": 600,
+    "change_stretch": 2,
+    "change_vague": 3,
+}
+
+
+# Implementations before vectorization, kept as the reference for numerical equivalence.
+
+
+class CheckStep(object):
+    def __init__(self, step):
+        self.step = step
+        self.index = 0
+
+    def __call__(self, *args):
+        self.index += 1
+        return self.index % self.step != 0
+
+
+def reference_rewardshape(D, shape):
+    x = shape[0] - D.shape[0]
+    y = shape[1] - D.shape[1]
+    if x > 0:
+        bottomlist = np.zeros([x, D.shape[1]])
+        D = np.r_[D, bottomlist]
+    if y > 0:
+        rightlist = np.zeros([D.shape[0], y])
+        D = np.c_[D, rightlist]
+    return D
+
+
+def reference_pool_step(D, step):
+    _shape = D.shape
+    if step < 2:
+        return D
+    cs = CheckStep(step)
+    return reference_rewardshape(np.array(list(filter(cs, D))), _shape)
+
+
+def reference_pool(D, size=(3, 3), shapeed=False):
+    _shape = D.shape
+    if isinstance(size, tuple):
+        if size[1] > 1:
+            D = reference__pool(D, size[1])
+        if size[0] > 1:
+            D = reference__pool(D.T, size[0]).T
+    elif isinstance(size, int):
+        D = reference__pool(D.T, size).T
+    if shapeed:
+        D = reference_rewardshape(D, _shape)
+    return D
+
+
+def reference__pool(D, poolsize):
+    x = D.shape[1] // poolsize
+    restsize = D.shape[1] % poolsize
+    if restsize > 0:
+        x += 1
+        rightlist = np.zeros([D.shape[0], poolsize - restsize])
+        D = np.c_[D, rightlist]
+    D = D.reshape((-1, poolsize))
+    D = D.sum(axis=1).reshape(-1, x)
+    return D
+
+
+def clip(seconds: float) -> np.ndarray:
+    """A voice-like synthetic clip: a gliding harmonic tone with some noise."""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * SR)) / SR
+    f0 = 150 + 50 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / SR
+    y = sum(np.sin(k * phase) / k for k in range(1, 6)) * 0.2
+    return (y + 0.01 * rng.standard_normal(len(t))).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def spectrum():
+    return librosa.stft(clip(5))
+
+
+@pytest.mark.parametrize("step", [1, 2, 3, 600, 1025, 2000])
+def test_pool_step_matches_reference(spectrum, step):
+    assert np.allclose(rosautils.pool_step(spectrum, step), reference_pool_step(spectrum, step))
+
+
+@pytest.mark.parametrize("size", [(1, 3), (3, 1), (3, 3), (2, 5), 2])
+@pytest.mark.parametrize("shapeed", [False, True])
+def test_pool_matches_reference(spectrum, size, shapeed):
+    result = rosautils.pool(spectrum, size, shapeed)
+    expected = reference_pool(spectrum, size, shapeed)
+    assert result.shape == expected.shape
+    assert np.allclose(result, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("pad", [(0, 0), (3, 0), (0, 2), (3, 2)])
+def test_rewardshape_matches_reference(spectrum, pad):
+    shape = (spectrum.shape[0] + pad[0], spectrum.shape[1] + pad[1])
+    assert np.array_equal(rosautils.rewardshape(spectrum, shape), reference_rewardshape(spectrum, shape))
+
+
+def test_effects_match_reference():
+    y = clip(5)
+    D = librosa.stft(y)
+    n = int(D.shape[0] * EFFECTS["change_pitchspeed"])
+    expected = {
+        "change_male": reference_pool_step(D, EFFECTS["change_male"]),
+        "change_vague": rosautils.spread(reference_pool(D, (1, EFFECTS["change_vague"])), (1, EFFECTS["change_vague"])),
+        "change_reback": rosautils.repeat(reference_pool(D, (1, EFFECTS["change_reback"])), EFFECTS["change_reback"]),
+        "change_pitchspeed": reference_rewardshape(D, (n, D.shape[1])),
+    }
+    for name, E in expected.items():
+        assert np.allclose(getattr(rosautils, name)(y, SR, EFFECTS[name]), librosa.istft(E), atol=1e-4), name
+
+
+@pytest.mark.parametrize("impl", ["numpy", "reference"])
+@pytest.mark.parametrize("helper", ["pool_step", "pool", "rewardshape"])
+def test_helper_speed(benchmark, helper, impl):
+    """Spectral helpers on the spectrum of a 60s clip, with the reference implementation for comparison."""
+    D = librosa.stft(clip(60))
+    func = getattr(rosautils, helper) if impl == "numpy" else globals()[f"reference_{helper}"]
+    args = {
+        "pool_step": (EFFECTS["change_male"],),
+        "pool": ((1, EFFECTS["change_vague"]),),
+        "rewardshape": ((int(D.shape[0] * 1.2), D.shape[1]),),
+    }[helper]
+    benchmark(func, D, *args)
+
+
+@pytest.mark.parametrize("seconds", [5, 60, 300])
+@pytest.mark.parametrize("effect", list(EFFECTS))
+def test_effect_speed(benchmark, effect, seconds):
+    y = clip(seconds)
+    benchmark.pedantic(getattr(rosautils, effect), args=(y, SR, EFFECTS[effect]), rounds=3 if seconds < 300 else 1)
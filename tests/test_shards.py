@@ -0,0 +1,134 @@
+import threading
+
+import pytest
+
+from anonyabbot.model import Message, shards
+
+
+@pytest.fixture
+def sharded(database, tmp_path):
+    shards.init(tmp_path / "shards", pragmas={"journal_mode": "wal"}, size=2)
+    shards.enabled = True
+    yield shards
+    shards.enabled = False
+    for group_id in list(shards.databases):
+        shards.drop(group_id)
+
+
+def count_in(group_id):
+    with shards.use(group_id):
+        return Message.select().count()
+
+
+def test_least_recently_used_files_are_closed(sharded):
+    opened = [sharded.open(group_id) for group_id in (1, 2)]
+    count_in(1)
+    count_in(3)
+    assert list(sharded.databases) == [1, 3]
+    assert opened[1].retired and not opened[1].connections
+    assert count_in(2) == 0
+
+
+def test_leased_files_are_closed_on_release(sharded):
+    with sharded.lease(1) as leased:
+        count_in(1)
+        count_in(2)
+        count_in(3)
+        assert not leased.retired and list(sharded.databases) == [1, 2, 3]
+    assert leased.retired
+    assert list(sharded.databases) == [2, 3]
+
+
+def test_database_calls_lease_the_current_file(settings, sharded):
+    import asyncio
+
+    from anonyabbot import dbio
+
+    async def main():
+        with shards.use(1):
+            return await dbio.io.write_shard(lambda: sharded.databases[1].leases)
+
+    try:
+        assert asyncio.run(main()) == 1
+    finally:
+        dbio.io.stop()
+    assert sharded.databases[1].leases == 0
+
+
+def test_drop_closes_connections_of_all_threads(sharded):
+    thread = threading.Thread(target=count_in, args=(1,))
+    thread.start()
+    thread.join()
+    count_in(1)
+    database = sharded.databases[1]
+    assert len(database.connections) == 2
+    sharded.drop(1)
+    assert not database.connections
+    assert not sharded.path(1).exists()
+
+
+def test_message_ids_are_not_reused(sharded):
+    from anonyabbot.model import BanGroup, Group, Member, MemberRole, User
+
+    creator = User.create(uid=1)
+    group = Group.create(uid=2, token="t", username="g", creator=creator, default_ban_group=BanGroup.generate())
+    member = Member.create(group=group, user=creator, role=MemberRole.CREATOR, last_delivered=100)
+    with shards.use(group.id):
+        first = Message.create(group=group, mid=1, member=member, mask="x")
+        assert first.id > 100
+        Message.delete().where(Message.id == first.id).execute()
+        assert Message.create(group=group, mid=2, member=member, mask="x").id > first.id
+
+
+def test_main_database_has_a_single_writer(settings, sharded, group):
+    import asyncio
+
+    from anonyabbot import dbio
+    from anonyabbot.model import Group, Member
+
+    group, members = group
+    threads = []
+
+    def thread_of(func):
+        def wrapped(*args, **kw):
+            threads.append(threading.current_thread().name)
+            return func(*args, **kw)
+
+        return wrapped
+
+    async def main():
+        with shards.use(group.id):
+            message = await dbio.create_message(group=group, mid=1, member=members[1], mask="x")
+            await dbio.io.write_shard(thread_of(lambda: None))
+            await dbio.io.write(thread_of(lambda: None))
+        return message
+
+    try:
+        message = asyncio.run(main())
+    finally:
+        dbio.io.stop()
+    shard_thread, main_thread = threads
+    assert shard_thread.startswith("db-write-") and main_thread == "db-write_0"
+    assert Group.get_by_id(group.id).message_count == 1
+    assert Member.get_by_id(members[1].id).message_count == 1
+    with shards.use(group.id):
+        assert Message.get_by_id(message.id).member_id == members[1].id
+
+
+def test_old_files_are_upgraded(sharded, group):
+    import asyncio
+
+    from anonyabbot import migrate
+    from anonyabbot.model import SHARD_VERSION, ReplyEntry, ReplyIndex
+
+    group, members = group
+    with shards.use(group.id):
+        message = Message.create(group=group, mid=1, member=members[0], mask="x")
+        ReplyEntry.delete().execute()
+        shards.execute_sql("PRAGMA user_version = 0")
+    assert asyncio.run(migrate.upgrade_shards()) == 1
+    with shards.use(group.id):
+        assert shards.execute_sql("PRAGMA user_version").fetchone()[0] == SHARD_VERSION
+        ReplyIndex._recent.clear()
+        assert ReplyIndex.resolve(members[0], 1) == message
+    assert asyncio.run(migrate.upgrade_shards()) == 0
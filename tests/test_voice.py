@@ -0,0 +1,85 @@
+"""
+Streamed and whole voice anonymization.
+Note:
+    data/voice.ogg is a 21s synthetic voiced tone at 16 kHz (a gliding harmonic series with slow amplitude modulation),
+    encoded with soundfile at compression_level=1.0 to keep it small. Streaming it in 10s blocks gives seams at 10s and 20s.
+    data/voice_reference.ogg is the output of the pydub/WAV pipeline of earlier versions for the same voice and effect
+    parameters, which decoded with ffmpeg at 48 kHz and exported with AudioSegment.export(format="ogg", bitrate="32k").
+"""
+
+from pathlib import Path
+import random
+
+import librosa
+import numpy as np
+import pytest
+
+from anonyabbot.bot.group import codec, voice
+
+DATA = Path(__file__).parent / "data" / "voice.ogg"
+REFERENCE = Path(__file__).parent / "data" / "voice_reference.ogg"
+SEAMS = (10, 20)
+
+
+@pytest.fixture(scope="module")
+def outputs():
+    """Decoded outputs of the whole and streamed paths, with the same random effect parameters."""
+    data = DATA.read_bytes()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(random, "choice", lambda seq: seq[-1])
+        whole, whole_duration, _ = voice.transform(data, stream_threshold=0)
+        streamed, streamed_duration, _ = voice.transform(data, stream_threshold=5)
+    whole, sr = codec.decode(whole)
+    streamed, _ = codec.decode(streamed)
+    return whole, streamed, sr, (whole_duration, streamed_duration)
+
+
+def mel_db(y, sr):
+    return librosa.power_to_db(librosa.feature.melspectrogram(y=y, sr=sr, n_fft=2048, hop_length=160, n_mels=40), ref=1.0)
+
+
+def high_band(y):
+    """Energy above a quarter of the sample rate in 4ms frames, where clicks of a broken seam show up."""
+    S = np.abs(librosa.stft(y, n_fft=256, hop_length=64))
+    return (S[S.shape[0] // 2:] ** 2).sum(axis=0)
+
+
+def test_streamed_voice_has_same_length(outputs):
+    whole, streamed, sr, (whole_duration, streamed_duration) = outputs
+    assert len(whole) == len(streamed) == codec.info(DATA.read_bytes()).frames
+    assert whole_duration == streamed_duration == 21
+
+
+def test_streamed_voice_matches_whole(outputs):
+    whole, streamed, sr, _ = outputs
+    diff = np.abs(mel_db(whole, sr) - mel_db(streamed, sr)).mean(axis=0)
+    frame = lambda s: int(s * sr / 160)
+    # The first block is processed exactly as the whole voice.
+    assert diff[frame(1):frame(9)].mean() < 0.1
+    # Later blocks restart the phase vocoder of the pitch shift, so they only match in level.
+    assert diff[frame(11):frame(19)].mean() < 3
+    for s in SEAMS:
+        assert diff[frame(s - 0.1):frame(s + voice.STREAM_OVERLAP + 0.1)].mean() < 3, s
+
+
+def test_streamed_voice_seams_do_not_click(outputs):
+    whole, streamed, sr, _ = outputs
+    a, b = high_band(whole), high_band(streamed)
+    frame = lambda s: int(s * sr / 64)
+    for s in SEAMS:
+        window = slice(frame(s - 0.1), frame(s + voice.STREAM_OVERLAP + 0.1))
+        assert b[window].max() < 1.5 * a[window].max(), s
+
+
+def test_voice_matches_reference(outputs):
+    whole, streamed, sr, (whole_duration, streamed_duration) = outputs
+    reference, _ = codec.decode(REFERENCE.read_bytes(), sr=sr)
+    # The old pipeline lost the tail trimmed by the inverse stft and truncated the duration, both are kept now.
+    assert 0 <= len(whole) - len(reference) < 512
+    assert whole_duration == streamed_duration == round(len(reference) / sr)
+    ref = mel_db(reference, sr)
+    for output in (whole, streamed):
+        # The old pipeline ran the effects at 48 kHz, which moves the bins removed by change_male a little.
+        # Outputs with the other effect parameters are about 7 dB away from the reference.
+        assert np.abs(mel_db(output[: len(reference)], sr) - ref).mean() < 3
+